@@ -2,145 +2,550 @@ import socket
 import os
 import sys
 import argparse
+import queue
+import threading
+import time
 from urllib.parse import urlparse
 
 # Define a constant for our buffer size
 
 BUFFER_SIZE = 1024
+READ_BUFFER_SIZE = 65536
 
-# A function for creating HTTP GET messages.
+# The number of files fetched at once by default, each by a worker thread with
+# connections of its own.
 
-def prepare_get_message(host, port, file_name):
-    request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n' 
-    return request
+FETCH_WORKERS = 4
 
+# The smallest segment of a file worth fetching over a connection of its own
+# when downloading a file in segments.
 
-# Read a single line (ending with \n) from a socket and return it.
-# We will strip out the \r and the \n in the process.
+MIN_SEGMENT_SIZE = 1024 * 1024
 
-def get_line_from_socket(sock):
+# A function for creating HTTP GET messages.  If we already have the first
+# offset bytes of the file, we ask for just the rest of it, or just up to the
+# last byte given.  Given the validator of the copy we have part of, we ask for
+# the rest only if the file is still that copy, and for the whole file again if
+# it has changed.
 
-    done = False
-    line = ''
-    while (not done):
-        char = sock.recv(1).decode()
-        if (char == '\r'):
-            pass
-        elif (char == '\n'):
-            done = True
-        else:
-            line = line + char
-    return line
+def prepare_get_message(host, port, file_name, offset=0, last=None, validator=''):
+    request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n'
+    if last is not None:
+        request += f'Range: bytes={offset}-{last}\r\n'
+    elif offset > 0:
+        request += f'Range: bytes={offset}-\r\n'
+    if (validator and ((last is not None) or (offset > 0))):
+        request += f'If-Range: {validator}\r\n'
+    return request + '\r\n'
+
+
+# A buffered reader wrapped around a connected socket.  Rather than pulling a
+# single byte at a time off the socket, we read whatever is available into a
+# reusable buffer and split lines out of that.  Anything left over once the
+# headers are done is handed back first when the body is read.
+
+class SocketReader:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.chunk = bytearray(READ_BUFFER_SIZE)
+        self.view = memoryview(self.chunk)
+
+    # Read more data from the socket into our buffer.  Returns the number of
+    # bytes read, which will be 0 once the other side closes the connection.
+
+    def fill(self):
+        count = self.sock.recv_into(self.chunk)
+        self.buffer += self.view[:count]
+        return count
+
+    # Read a single line (ending with \r\n) and return it.  We will strip out
+    # the \r and the \n in the process.
+
+    def get_line(self):
+        start = 0
+        while True:
+            index = self.buffer.find(b'\r\n', start)
+            if (index >= 0):
+                line = self.buffer[:index].decode()
+                del self.buffer[:index + 2]
+                return line
+            start = max(len(self.buffer) - 1, 0)
+            if (self.fill() == 0):
+                line = self.buffer.decode()
+                self.buffer.clear()
+                return line
+
+    # Read up to size bytes of a message body, returning anything still in our
+    # buffer before going back to the socket.
+
+    def recv(self, size):
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        return self.sock.recv(size)
+
+# The validator of a file we download, its ETag or failing that its
+# Last-Modified date, is kept in a file alongside it, so that a download we
+# resume later can make sure the rest of the file comes from the same copy.
+# We return an empty string if we don't have one.
+
+def read_validator(local_name):
+
+    try:
+        with open(local_name + '.validator') as validator_file:
+            return validator_file.read().strip()
+    except OSError:
+        return ''
+
+def save_validator(local_name, validator):
+
+    if validator:
+        with open(local_name + '.validator', 'w') as validator_file:
+            validator_file.write(validator + '\n')
 
 # Read a file from the socket and print it out.  (For errors primarily.)
 
-def print_file_from_socket(sock, bytes_to_read):
+def print_file_from_socket(reader, bytes_to_read):
 
     bytes_read = 0
     while (bytes_read < bytes_to_read):
-        chunk = sock.recv(BUFFER_SIZE)
+        chunk = reader.recv(min(BUFFER_SIZE, bytes_to_read - bytes_read))
+        if (not chunk):
+            break
         bytes_read += len(chunk)
         print(chunk.decode())
 
-# Read a file from the socket and save it out.
+# Read a file from the socket and save it out.  If we are given an offset, what
+# we read is the rest of the file from there on, so we write it over what we
+# have from that point rather than starting the file afresh.
 
-def save_file_from_socket(sock, bytes_to_read, file_name):
+def save_file_from_socket(reader, bytes_to_read, file_name, offset=None):
 
-    with open(file_name, 'wb') as file_to_write:
+    with open(file_name, 'wb' if (offset is None) else 'r+b') as file_to_write:
+        if offset is not None:
+            file_to_write.seek(offset)
+            file_to_write.truncate()
         bytes_read = 0
         while (bytes_read < bytes_to_read):
-            chunk = sock.recv(BUFFER_SIZE)
+            chunk = reader.recv(min(READ_BUFFER_SIZE, bytes_to_read - bytes_read))
+            if (not chunk):
+                raise ConnectionError('server closed the connection')
             bytes_read += len(chunk)
             file_to_write.write(chunk)
 
+# Read the headers of a response, returning them in a dictionary keyed by their
+# names in lower case.
 
-# Our main function.
+def read_headers(reader):
 
-def main():
+    headers = {}
+    header_line = reader.get_line()
+    while (header_line != ''):
+        name, _, value = header_line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+        header_line = reader.get_line()
+    return headers
 
-    # Check command line arguments to retrieve a URL.
+# Read part of a file from the socket and write it into an open file at the
+# given offset, so several parts can be written into the same file at once.
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("url", help="URL to fetch with an HTTP GET request")
-    args = parser.parse_args()
+def write_file_from_socket(reader, bytes_to_read, fd, offset):
+
+    end = offset + bytes_to_read
+    while (offset < end):
+        chunk = reader.recv(min(READ_BUFFER_SIZE, end - offset))
+        if (not chunk):
+            raise ConnectionError('server closed the connection')
+        view = memoryview(chunk)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            offset += written
+            view = view[written:]
 
-    # Check the URL passed in and make sure it's valid.  If so, keep track of
-    # things for later.
+# Set aside room on disk for a file of the given size up front, so the parts of
+# it can be written in any order without the file growing as we go.  Where the
+# file system can't reserve the space for us, we just set the file's size.
+
+def preallocate_file(fd, size):
 
     try:
-        parsed_url = urlparse(args.url)
-        if ((parsed_url.scheme != 'http') or (parsed_url.port == None) or (parsed_url.path == '') or (parsed_url.path == '/') or (parsed_url.hostname == None)):
-            raise ValueError
-        host = parsed_url.hostname
-        port = parsed_url.port
-        file_name = parsed_url.path
-    except ValueError:
-        print('Error:  Invalid URL.  Enter a URL of the form:  http://host:port/file')
-        sys.exit(1)
+        if (size > 0):
+            os.posix_fallocate(fd, 0, size)
+            return
+    except (AttributeError, OSError):
+        pass
+    os.ftruncate(fd, size)
+
+# Ask for bytes first to last of a file over an open connection.  We return the
+# response line and a dictionary of its headers, leaving the body to be read.
+
+def send_range_request(client_socket, reader, host, port, file_name, first, last):
+
+    message = prepare_get_message(host, port, file_name, first, last)
+    client_socket.sendall(message.encode())
+    response_line = reader.get_line()
+    if (response_line == ''):
+        raise ConnectionError('server closed the connection')
+    return [response_line, read_headers(reader)]
+
+# Fetch bytes first to last of a file over a connection of its own and write
+# them into place in the open file.  This runs in a thread of its own, so
+# anything that goes wrong is added to errors for the caller to report.
+
+def fetch_segment(host, port, file_name, fd, first, last, errors):
 
-    # Now we try to make a connection to the server.
+    try:
+        with socket.create_connection((host, port)) as client_socket:
+            reader = SocketReader(client_socket)
+            response_line, headers = send_range_request(client_socket, reader, host, port, file_name, first, last)
+            expected = 'bytes ' + str(first) + '-' + str(last) + '/'
+            if ((response_line.split(' ')[1] != '206') or (not headers.get('content-range', '').startswith(expected))):
+                raise ConnectionError(f'{host}:{port} did not send bytes {first}-{last}:  {response_line}')
+            write_file_from_socket(reader, last - first + 1, fd, first)
+    except OSError as error:
+        errors.append(error)
+
+# Download a file in segments fetched at the same time over several
+# connections, writing each into place in a file set to its full size up
+# front.  The segments are spread over the servers given, in turn.  We first
+# ask the first server for just the first byte of the file to find out how big
+# it is; files too small to be worth splitting so many ways are fetched in
+# fewer segments, and if the server sends back the whole file instead we just
+# save that.  We return whether the file was downloaded.
+
+def download_segments(servers, file_name, segments):
 
+    local_name = get_local_name(file_name)
+    host, port = servers[0]
     print('Connecting to server ...')
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((host, port))
+        with socket.create_connection((host, port)) as client_socket:
+            reader = SocketReader(client_socket)
+            response_line, headers = send_range_request(client_socket, reader, host, port, file_name, 0, 0)
+            print(response_line)
+            code = response_line.split(' ')[1]
+            bytes_to_read = int(headers.get('content-length', 0))
+            if (code == '200'):
+                print('Success:  Server is sending the whole file.  Downloading it now.')
+                save_file_from_socket(reader, bytes_to_read, local_name)
+                return True
+            elif ((code != '206') and (code != '416')):
+                print('Error:  An error response was received from the server.  Details:\n')
+                print_file_from_socket(reader, bytes_to_read)
+                return False
+            total = int(headers.get('content-range', '').split('/')[-1])
     except ConnectionRefusedError:
         print('Error:  That host or port is not accepting connections.')
-        sys.exit(1)
+        return False
+    except (OSError, ValueError) as error:
+        print('Error:  Finding out the size of the file failed:', error)
+        return False
 
-    # The connection was successful, so we can prep and send our message.
-    
-    print('Connection to server established. Sending message...\n')
-    message = prepare_get_message(host, port, file_name)
-    client_socket.send(message.encode())
+    # Split the file into segments of equal size, each at least
+    # MIN_SEGMENT_SIZE bytes, and fetch them all at once.
+
+    count = max(1, min(segments, total // MIN_SEGMENT_SIZE))
+    size = -(-total // count)
+    print(f'Success:  Downloading {total} bytes in {count} segments now.')
+    fd = os.open(local_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    errors = []
+    try:
+        preallocate_file(fd, total)
+        threads = []
+        for i in range(count):
+            first = i * size
+            last = min(first + size, total) - 1
+            if (first > last):
+                break
+            host, port = servers[i % len(servers)]
+            thread = threading.Thread(target=fetch_segment, args=(host, port, file_name, fd, first, last, errors))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    finally:
+        os.close(fd)
+
+    if errors:
+        print('Error:  Downloading a segment of the file failed:', errors[0])
+        return False
+    return True
+
+# Work out the name to save a requested file under.  If requested file begins
+# with a / we strip it off.
+
+def get_local_name(file_name):
+
+    while (file_name[0] == '/'):
+        file_name = file_name[1:]
+    return file_name
+
+# Check the URL passed in and make sure it's valid.  If so, return the host,
+# port and file it refers to, and raise a ValueError if not.
+
+def parse_url(url):
+
+    parsed_url = urlparse(url)
+    if ((parsed_url.scheme != 'http') or (parsed_url.port == None) or (parsed_url.path == '') or (parsed_url.path == '/') or (parsed_url.hostname == None)):
+        raise ValueError
+    return parsed_url.hostname, parsed_url.port, parsed_url.path
+
+# Fetch a single file over an open connection to the server.  We return None if
+# the server closed the connection before responding; otherwise we return
+# whether the file was downloaded and whether the server will keep the
+# connection open for another request.
+
+def fetch_file(client_socket, reader, host, port, file_name, resume=False):
+
+    local_name = get_local_name(file_name)
+
+    # If we are resuming a download, ask for just the part of the file we
+    # don't have yet, provided it is still the copy we have part of.  If we
+    # don't know which copy that was, we have to start again.
+
+    offset = 0
+    validator = ''
+    if (resume and os.path.exists(local_name)):
+        validator = read_validator(local_name)
+        if validator:
+            offset = os.path.getsize(local_name)
+    message = prepare_get_message(host, port, file_name, offset, validator=validator)
+    client_socket.sendall(message.encode())
    
     # Receive the response from the server and start taking a look at it
 
-    response_line = get_line_from_socket(client_socket)
+    response_line = reader.get_line()
+    if (response_line == ''):
+        return None
     response_list = response_line.split(' ')
     headers_done = False
+    keep_alive = True
         
     # If an error is returned from the server, we dump everything sent and
-    # exit right away.  
+    # move on to the next file.
     
-    if response_list[1] != '200':
-        print('Error:  An error response was received from the server.  Details:\n')
+    if ((response_list[1] != '200') and (response_list[1] != '206')):
+        complete = ((response_list[1] == '416') and (offset > 0))
+        if complete:
+            print('Our copy of the file is already complete.  Details:\n')
+        else:
+            print('Error:  An error response was received from the server.  Details:\n')
         print(response_line);
         bytes_to_read = 0
         while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
+            header_line = reader.get_line()
             print(header_line)
             header_list = header_line.split(' ')
             if (header_line == ''):
                 headers_done = True
             elif (header_list[0] == 'Content-Length:'):
                 bytes_to_read = int(header_list[1])
-        print_file_from_socket(client_socket, bytes_to_read)
-        sys.exit(1)
+            elif (header_list[0] == 'Connection:'):
+                keep_alive = (header_list[1] != 'close')
+        print_file_from_socket(reader, bytes_to_read)
+        return [complete, keep_alive]
            
     
-    # If it's OK, we retrieve and write the file out.
+    # If it's OK, we retrieve and write the file out.  For a 206 we were sent
+    # the rest of a file we already have part of, starting where the
+    # Content-Range header says, so we write it in from there.
 
     else:
 
-        print('Success:  Server is sending file.  Downloading it now.')
-
-        # If requested file begins with a / we strip it off.
-
-        while (file_name[0] == '/'):
-            file_name = file_name[1:]
+        if (response_list[1] == '206'):
+            print('Success:  Server is sending the rest of the file.  Resuming download now.')
+        else:
+            print('Success:  Server is sending file.  Downloading it now.')
 
         # Go through headers and find the size of the file, then save it.
    
         bytes_to_read = 0
+        start = offset if (response_list[1] == '206') else None
+        etag = ''
+        last_modified = ''
         while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
+            header_line = reader.get_line()
             header_list = header_line.split(' ')
             if (header_line == ''):
                 headers_done = True
             elif (header_list[0] == 'Content-Length:'):
                 bytes_to_read = int(header_list[1])
-        save_file_from_socket(client_socket, bytes_to_read, file_name)
+            elif (header_list[0] == 'Connection:'):
+                keep_alive = (header_list[1] != 'close')
+            elif ((header_list[0] == 'Content-Range:') and (start is not None)):
+                start = int(header_list[2].split('-')[0])
+            elif (header_list[0] == 'ETag:'):
+                etag = header_line.partition(' ')[2]
+            elif (header_list[0] == 'Last-Modified:'):
+                last_modified = header_line.partition(' ')[2]
+        save_validator(local_name, etag or last_modified)
+        save_file_from_socket(reader, bytes_to_read, local_name, start)
+        return [True, keep_alive]
+
+# Get a file from the server, reusing our open connection to it if we have one.
+# Connections are kept in a dictionary by host and port.  If a connection we
+# reused turns out to have been closed by the server, we try again on a new one.
+# If resume is set, we carry on from any partial copy of the file we already
+# have.  If segments is more than one, the file is downloaded in that many
+# segments at once over connections of their own instead.  We return whether
+# the file was downloaded.
+
+def get_file(connections, host, port, file_name, resume, segments):
+
+    if (segments > 1):
+        return download_segments([(host, port)], file_name, segments)
+
+    while True:
+        reused = ((host, port) in connections)
+
+        # Now we try to make a connection to the server.
+
+        if (not reused):
+            print('Connecting to server ...')
+            try:
+                client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                client_socket.connect((host, port))
+                reader = SocketReader(client_socket)
+            except ConnectionRefusedError:
+                print('Error:  That host or port is not accepting connections.')
+                return False
+            connections[(host, port)] = [client_socket, reader]
+
+        # The connection was successful, so we can prep and send our message.
+
+        print('Connection to server established. Sending message...\n')
+        client_socket, reader = connections[(host, port)]
+        try:
+            result = fetch_file(client_socket, reader, host, port, file_name, resume)
+        except OSError as error:
+            print('Error:  Connection to server failed:', error)
+            result = None
+
+        # Close the connection if the server is done with it or it failed.
+
+        if ((result is None) or (not result[1])):
+            client_socket.close()
+            del connections[(host, port)]
+        if (result is not None):
+            return result[0]
+        if (not reused):
+            return False
+
+
+# Fetch the file at a URL with the options given on the command line.  We
+# return the size of the file downloaded, or None if it wasn't.
+
+def fetch_url(connections, url, args):
+
+    try:
+        host, port, file_name = parse_url(url)
+    except ValueError:
+        print('Error:  Invalid URL.  Enter a URL of the form:  http://host:port/file')
+        return None
+    if (not get_file(connections, host, port, file_name, args.resume, args.segments)):
+        return None
+    try:
+        return os.path.getsize(get_local_name(file_name))
+    except OSError:
+        return 0
+
+# Read the URLs to fetch from a file, one to a line, or from standard input if
+# the file name is -.  Blank lines and lines starting with # are skipped.
+
+def read_urls(file_name):
+
+    if (file_name == '-'):
+        lines = sys.stdin.readlines()
+    else:
+        with open(file_name) as url_file:
+            lines = url_file.readlines()
+    return [line.strip() for line in lines if (line.strip() != '') and (not line.startswith('#'))]
+
+# Fetch URLs from the queue one after another until there are none left,
+# adding the URL, the size of the file downloaded (None if it wasn't) and how
+# many seconds it took to the results for each.  Each worker keeps connections
+# of its own open between files, so files from the same host and port share a
+# connection without workers having to wait on each other.
+
+def run_worker(urls, results, args):
+
+    connections = {}
+    while True:
+        try:
+            url = urls.get_nowait()
+        except queue.Empty:
+            break
+        start_time = time.perf_counter()
+        size = fetch_url(connections, url, args)
+        results.append((url, size, time.perf_counter() - start_time))
+    for client_socket, reader in connections.values():
+        client_socket.close()
+
+# Fetch all the URLs given with a pool of worker threads, at most workers files
+# at a time.  We return the results for each file along with how many seconds
+# it took to fetch them all.
+
+def fetch_urls(url_list, workers, args):
+
+    urls = queue.Queue()
+    for url in url_list:
+        urls.put(url)
+    results = []
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=run_worker, args=(urls, results, args)) for i in range(max(1, min(workers, len(url_list))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start_time
+
+# Print a summary of how fetching a batch of files went: how many were
+# downloaded, how fast, and how long each took.
+
+def print_summary(results, elapsed):
+
+    latencies = sorted(latency for url, size, latency in results if size is not None)
+    total_bytes = sum(size for url, size, latency in results if size is not None)
+    print('\nSummary:')
+    for url, size, latency in results:
+        print(f'  {"ok" if (size is not None) else "FAILED":>6}  {latency:8.3f} s  {url}')
+    print(f'Downloaded {len(latencies)} of {len(results)} files, {total_bytes} bytes in {elapsed:.3f} s ({total_bytes / max(elapsed, 1e-9) / (1024 * 1024):.2f} MB/s, {len(results) / max(elapsed, 1e-9):.1f} files/s)')
+    if latencies:
+        average = sum(latencies) / len(latencies)
+        median = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f'Latency per file:  min {latencies[0]:.3f} s  avg {average:.3f} s  median {median:.3f} s  95th {p95:.3f} s  max {latencies[-1]:.3f} s')
+
+# Our main function.
+
+def main():
+
+    # Check command line arguments to retrieve the URLs.
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", nargs='*', help="URLs to fetch with HTTP GET requests")
+    parser.add_argument("-batch", help="File of URLs to fetch, one to a line (- for standard input)")
+    parser.add_argument("-workers", type=int, default=FETCH_WORKERS, help="Number of files to fetch at once")
+    parser.add_argument("-resume", action='store_true', help="Carry on from partial copies of files already downloaded")
+    parser.add_argument("-segments", type=int, default=1, help="Number of segments to download each file in at once")
+    args = parser.parse_args()
+    url_list = list(args.url)
+    if args.batch is not None:
+        url_list += read_urls(args.batch)
+    if (not url_list):
+        parser.error('no URLs given to fetch')
+
+    # Fetch the files with a pool of workers, each keeping connections open
+    # between files so files from the same server share a connection.
+
+    results, elapsed = fetch_urls(url_list, args.workers, args)
+    if (len(results) > 1):
+        print_summary(results, elapsed)
+    if (any(size is None for url, size, latency in results)):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
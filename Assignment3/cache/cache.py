@@ -1,22 +1,106 @@
 import socket
 import os
-import datetime
 import signal
 import sys
+import argparse
+import asyncio
+import threading
+import time
+import heapq
+import json
+import queue
+import shutil
+import tempfile
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
-EXPIRE_TIME = 120
 BUFFER_SIZE = 1024
+READ_BUFFER_SIZE = 65536
+LISTEN_BACKLOG = 128
+
+# Constants for how long files stay fresh when the server doesn't tell us in a
+# Cache-Control header: how many seconds a file is served without checking
+# with the server, how many seconds after that a stale copy is still served
+# while it is checked in the background, and how many seconds after that a
+# stale copy is served if the server can't be reached.  We also say how many
+# threads check stale files in the background.
+
+DEFAULT_MAX_AGE = 30
+DEFAULT_STALE_WHILE_REVALIDATE = 90
+DEFAULT_STALE_IF_ERROR = 3600
+REVALIDATE_WORKERS = 4
+
+# The responses from a server that mean it is having trouble, rather than that
+# there is anything wrong with the request.
+
+SERVER_ERRORS = ['500', '502', '503', '504']
+
+# Constants for keep-alive connections: how many seconds we keep an idle client
+# connection open, and how many idle connections to each server we hold on to
+# for reuse and for how long.  We also say how many seconds we wait on a server
+# to connect and to send us anything before giving up on it.
+
+IDLE_TIMEOUT = 15
+MAX_IDLE_CONNECTIONS = 8
+POOL_IDLE_TIMEOUT = 10
+CONNECT_TIMEOUT = 5
+SERVER_TIMEOUT = 30
+
+# Constants for sending files: whether the kernel can copy files straight to a
+# socket for us, and how much to read at a time when it can't.
+
+USE_SENDFILE = hasattr(os, 'sendfile')
+SEND_BUFFER_SIZE = 262144
+
+# Constants for the in-memory tier in front of the files in the cache: how many
+# megabytes of files we keep in memory by default, and the largest file we will
+# hold there.  Anything bigger is always sent from disk.
+
+MEMORY_CACHE_SIZE = 64
+MAX_MEMORY_OBJECT_SIZE = 4 * 1024 * 1024
+
+# Constants for the files kept on disk: how many megabytes and how many files
+# we keep by default, and how we pick which file to drop once we have too many.
+
+CACHE_SIZE = 1024
+MAX_CACHE_ENTRIES = 10000
+EVICTION_POLICY = 'lru'
+
+# Whether files fetched from the server are sent on to the client as they
+# arrive, rather than once they have been saved to the cache.
+
+TEE_MODE = False
+
+# The file we keep the index of the cache in, so it survives restarts, and how
+# many seconds uses of files pile up in memory before we write them to it.
+
+INDEX_FILE = 'cache_index.log'
+INDEX_FLUSH_INTERVAL = 5
+
+# Constants for parts of files asked for with a Range header that we don't have
+# the whole of: how many megabytes a file must be before we keep the parts of
+# it we fetch rather than just passing them on, how many megabytes of such
+# parts we keep, and the directory we keep them in.
+
+LARGE_OBJECT_SIZE = 16
+CHUNK_CACHE_SIZE = 256
+CHUNK_DIR = 'chunks'
 
 # Read a file from the socket and print it out.  (For errors primarily.)
+# We return what was read so it can be passed back to the client.
 
-def print_file_from_socket(sock, bytes_to_read):
+def print_file_from_socket(reader, bytes_to_read):
 
     bytes_read = 0
+    body = b''
     while (bytes_read < bytes_to_read):
-        chunk = sock.recv(BUFFER_SIZE)
+        chunk = reader.recv(min(BUFFER_SIZE, bytes_to_read - bytes_read))
+        if (not chunk):
+            break
         bytes_read += len(chunk)
-        print(chunk.decode())
-        return chunk.decode()
+        body += chunk
+    print(body.decode())
+    return body
 
 # Signal handler for graceful exiting.
 
@@ -24,11 +108,23 @@ def signal_handler(sig, frame):
     print('Interrupt received, shutting down ...')
     sys.exit(0)
 
+# The Date header for the current second, along with the second it is for.
+# Every response sent within the same second shares it, so we only have to
+# format the date once a second.
+
+date_header = (0, '')
+
+def get_date_header():
+    global date_header
+    now = int(time.time())
+    if (date_header[0] != now):
+        date_header = (now, 'Date: ' + formatdate(now, usegmt=True))
+    return date_header[1]
+
 # Create an HTTP response
 
 def prepare_response_message(value):
-    date = datetime.datetime.now()
-    date_string = 'Date: ' + date.strftime('%a, %d %b %Y %H:%M:%S EDT')
+    date_string = get_date_header()
     message = 'HTTP/1.1 '
     if value == '200':
         message = message + value + ' OK\r\n' + date_string + '\r\n'
@@ -40,14 +136,26 @@ def prepare_response_message(value):
         message = message + value + ' Version Not Supported\r\n' + date_string + '\r\n'
     elif value == '304':
         message = message + value + ' Not Modified\r\n'+date_string+'\r\n'
+    elif value == '206':
+        message = message + value + ' Partial Content\r\n' + date_string + '\r\n'
+    elif value == '416':
+        message = message + value + ' Range Not Satisfiable\r\n' + date_string + '\r\n'
+    elif value == '502':
+        message = message + value + ' Bad Gateway\r\n' + date_string + '\r\n'
     return message
 
-# Send the given response and file back to the client.
+# Construct the header telling the client whether we will keep the connection
+# open after this response.
 
-def send_response_to_client(sock, code, file_name):
+def prepare_connection_header(keep_alive):
+    if keep_alive:
+        return 'Connection: keep-alive\r\n'
+    else:
+        return 'Connection: close\r\n'
 
-    # Determine content type of file
+# Work out the content type of a file from its extension.
 
+def get_content_type(file_name):
     if ((file_name.endswith('.jpg')) or (file_name.endswith('.jpeg'))):
         type = 'image/jpeg'
     elif (file_name.endswith('.gif')):
@@ -58,325 +166,1754 @@ def send_response_to_client(sock, code, file_name):
         type = 'text/html'
     else:
         type = 'application/octet-stream'
-    
-    # Get size of file
+    return type
+
+# Construct the headers describing the content of a file.
+
+def prepare_content_header(content_type, file_size):
+    return 'Content-Type: ' + content_type + '\r\nContent-Length: ' + str(file_size) + '\r\n'
+
+# Construct the headers describing part of a file, running from its first to
+# its last byte, out of a file of the given total size.
+
+def prepare_partial_header(content_type, first, last, total):
+    return prepare_content_header(content_type, last - first + 1) + 'Content-Range: bytes ' + str(first) + '-' + str(last) + '/' + str(total) + '\r\n'
+
+# Construct the header for a 416, telling the client how big the file really is.
+
+def prepare_unsatisfiable_header(total):
+    return prepare_response_message('416') + 'Content-Range: bytes */' + str(total) + '\r\nContent-Length: 0\r\n'
+
+# Construct the headers describing the whole of a file we have in the cache
+# with the given record.
+
+def prepare_cached_header(record):
+    return prepare_content_header(record['type'], record['size']) + prepare_validator_header(record['modified'], record.get('etag', '')) + 'Accept-Ranges: bytes\r\n'
+
+# Construct the headers giving the validators of a file, for clients to check
+# their copy of it with us later.  Either may be missing if the server didn't
+# give us one.
+
+def prepare_validator_header(last_modified, etag):
+    header = ''
+    if last_modified:
+        header = header + 'Last-Modified: ' + last_modified + '\r\n'
+    if etag:
+        header = header + 'ETag: ' + etag + '\r\n'
+    return header
+
+# Check a conditional request from a client against the validators of our copy
+# of a file, returning whether the client's copy is still good.  We go by the
+# entity tag if the client sent one, and by when the file was last modified
+# otherwise, only parsing the dates if the client didn't send back the exact
+# Last-Modified we gave it.
+
+def not_modified(headers, last_modified, etag):
+    if ('if-none-match' in headers):
+        tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+        return ((etag != '') and (('*' in tags) or (etag in tags) or (('W/' + etag) in tags)))
+    if (('if-modified-since' not in headers) or (not last_modified)):
+        return False
+    since = headers['if-modified-since']
+    if (since == last_modified):
+        return True
+    since_time = parsedate_tz(since)
+    modified_time = parsedate_tz(last_modified)
+    if ((since_time is None) or (modified_time is None)):
+        return False
+    return (mktime_tz(modified_time) <= mktime_tz(since_time))
+
+# Check whether a request asks for a single range of bytes of a file, which is
+# the only kind of Range header we handle.  Anything else gets the whole file.
+
+def wants_range(headers):
+    value = headers.get('range', '')
+    return ((value.startswith('bytes=')) and (',' not in value))
+
+# Work out which bytes of a file of the given size a request with a Range
+# header asks for.  We return None if the whole file should be sent, the first
+# and last bytes to send if the range is one we can send, and False if it
+# starts past the end of the file.  If the request came with an If-Range header
+# that doesn't match the validators of our copy, the client's partial copy is
+# out of date, so the whole file is sent.
+
+def parse_range(headers, size, last_modified, etag):
+    if (not wants_range(headers)):
+        return None
+    if (('if-range' in headers) and (headers['if-range'] not in (etag, last_modified))):
+        return None
+    first, _, last = headers['range'][6:].strip().partition('-')
+    try:
+        if (first == ''):
+            first = size - int(last)
+            last = size - 1
+        else:
+            first = int(first)
+            last = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if (first >= size):
+        return False
+    if (last < first):
+        return None
+    return (max(first, 0), min(last, size - 1))
+
+# Work out which bytes of a file a 206 from the server holds from its
+# Content-Range header.  We return the first and last bytes and the size of the
+# whole file, or None if we can't make sense of it.
+
+def parse_content_range(value):
+    try:
+        unit, _, value = value.partition(' ')
+        byte_range, _, total = value.partition('/')
+        first, _, last = byte_range.partition('-')
+        if (unit != 'bytes'):
+            return None
+        return int(first), int(last), int(total)
+    except ValueError:
+        return None
+
+# Work out how long a file stays fresh from the Cache-Control header the server
+# sent with it.  We return the number of seconds it is fresh for, how many
+# seconds after that it can be served while it is checked in the background,
+# and how many seconds after that it can be served if the server can't be
+# reached.  Anything the server doesn't say falls back to our defaults.
+
+def get_freshness(headers):
+    max_age = DEFAULT_MAX_AGE
+    shared_max_age = None
+    stale_while_revalidate = DEFAULT_STALE_WHILE_REVALIDATE
+    stale_if_error = DEFAULT_STALE_IF_ERROR
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().lower().partition('=')
+        if ((name == 'no-cache') or (name == 'no-store')):
+            return 0, 0, stale_if_error
+        try:
+            seconds = int(value.strip('"'))
+        except ValueError:
+            continue
+        if (name == 'max-age'):
+            max_age = seconds
+        elif (name == 's-maxage'):
+            shared_max_age = seconds
+        elif (name == 'stale-while-revalidate'):
+            stale_while_revalidate = seconds
+        elif (name == 'stale-if-error'):
+            stale_if_error = seconds
+    if (shared_max_age is not None):
+        max_age = shared_max_age
+    return max_age, stale_while_revalidate, stale_if_error
+
+# Construct the header for a response sending back a file with the given
+# content headers.
+
+def prepare_response_header(code, content_header, keep_alive):
+    return prepare_response_message(code) + content_header + prepare_connection_header(keep_alive) + '\r\n'
+
+# Construct an error response passed back from the server, replacing whatever
+# the server said about its connection with what we will do with ours.
+
+def prepare_error_response(message, body, keep_alive):
+    return (message + prepare_connection_header(keep_alive) + '\r\n').encode() + body
+
+# Construct a 502, for when the server let us down before we could send the
+# client anything.
+
+def prepare_bad_gateway_response(keep_alive):
+    return prepare_error_response(prepare_response_message('502') + 'Content-Length: 0\r\n', b'', keep_alive)
+
+# Send the contents of an open file down a socket.  Where we can, we let the
+# kernel copy the file straight to the socket with sendfile.  Otherwise we fall
+# back to reading the file into one large buffer at a time and sending that.
+
+def send_file_to_socket(sock, file_to_send):
+
+    if USE_SENDFILE:
+        sock.sendfile(file_to_send)
+        return
+
+    buffer = bytearray(SEND_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        count = file_to_send.readinto(buffer)
+        if count:
+            sock.sendall(view[:count])
+        else:
+            break
 
-    file_size = os.path.getsize(file_name)
+# Send the given response and file back to the client.
+
+def send_response_to_client(sock, code, file_name, content_header, keep_alive):
 
     # Construct header and send it
 
-    header = prepare_response_message(code) + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(file_size) + '\r\n\r\n'
-    sock.send(header.encode())
+    header = prepare_response_header(code, content_header, keep_alive)
+    sock.sendall(header.encode())
 
-    # Open the file, read it, and send it
+    # Open the file and send it
 
     with open(file_name, 'rb') as file_to_send:
-        while True:
-            chunk = file_to_send.read(BUFFER_SIZE)
-            if chunk:
-                sock.send(chunk)
-            else:
-                break
+        send_file_to_socket(sock, file_to_send)
 
-# A function for creating HTTP GET messages.
+# Send a file held in memory back to the client, sending the whole response
+# in one go.
 
-def prepare_get_message(host, port, file_name, time=''):
-    if time!='':
-        request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\nIf-modified-since: {time}\r\n' 
-        return request
-    else:
-        request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n' 
-        return request
+def send_memory_response_to_client(sock, content_header, body, keep_alive, code='200'):
 
-# Read a single line (ending with \n) from a socket and return it.
-# We will strip out the \r and the \n in the process.
+    header = prepare_response_header(code, content_header, keep_alive)
+    sock.sendall(header.encode() + body)
 
-def get_line_from_socket(sock):
+# Send the given response and file back to the client over a stream.
 
-    done = False
-    line = ''
-    while (not done):
-        char = sock.recv(1).decode()
-        if (char == '\r'):
-            pass
-        elif (char == '\n'):
-            done = True
-        else:
-            line = line + char
-    return line
+async def send_response_to_stream(writer, code, file_name, content_header, keep_alive):
+
+    # Construct header and send it
+
+    header = prepare_response_header(code, content_header, keep_alive)
+    writer.write(header.encode())
+
+    # Open the file and send it.  The event loop uses sendfile where it can,
+    # and otherwise reads the file in and writes it out for us.
+
+    with open(file_name, 'rb') as file_to_send:
+        await asyncio.get_running_loop().sendfile(writer.transport, file_to_send)
+
+# Send a file held in memory back to the client over a stream.
+
+async def send_memory_response_to_stream(writer, content_header, body, keep_alive, code='200'):
+
+    header = prepare_response_header(code, content_header, keep_alive)
+    writer.write(header.encode() + body)
+    await writer.drain()
+
+# Send part of an open file down a socket, starting at the given offset.
+
+def send_file_range_to_socket(sock, file_to_send, offset, count):
+
+    if USE_SENDFILE:
+        sock.sendfile(file_to_send, offset, count)
+        return
+
+    end = offset + count
+    while (offset < end):
+        chunk = os.pread(file_to_send.fileno(), min(SEND_BUFFER_SIZE, end - offset), offset)
+        if (not chunk):
+            break
+        sock.sendall(chunk)
+        offset += len(chunk)
+
+# Send part of a file back to the client as a 206, starting at the given offset.
+
+def send_range_response_to_client(sock, file_name, content_header, offset, count, keep_alive):
+
+    header = prepare_response_header('206', content_header, keep_alive)
+    sock.sendall(header.encode())
+    with open(file_name, 'rb') as file_to_send:
+        send_file_range_to_socket(sock, file_to_send, offset, count)
+
+# Send part of a file back to the client over a stream as a 206.
+
+async def send_range_response_to_stream(writer, file_name, content_header, offset, count, keep_alive):
+
+    header = prepare_response_header('206', content_header, keep_alive)
+    writer.write(header.encode())
+    with open(file_name, 'rb') as file_to_send:
+        await asyncio.get_running_loop().sendfile(writer.transport, file_to_send, offset, count)
+
+# Send count bytes of a file from the given offset back to the client as it is
+# being downloaded from the server, sending on each part as soon as it has
+# arrived.  This is the whole file for a 200, or the part the client asked for
+# for a 206.  If the download has already failed the client gets a 502, and if
+# it fails once we have started, all we can do is give up on the connection.
+
+def send_download_to_client(sock, code, download, content_header, offset, count, keep_alive):
+
+    file_to_send = download.open()
+    if (file_to_send is None):
+        print('Download from the server failed ... responding with error!')
+        sock.sendall(prepare_bad_gateway_response(keep_alive))
+        return
+
+    with file_to_send:
+        header = prepare_response_header(code, content_header, keep_alive)
+        sock.sendall(header.encode())
+        end = offset + count
+        while (offset < end):
+            received = download.wait(offset)
+            if (received is None):
+                raise ConnectionError('download from the server failed')
+            received = min(received, end)
+            send_file_range_to_socket(sock, file_to_send, offset, received - offset)
+            offset = received
+
+# Send part of a file back to the client over a stream as it is being
+# downloaded from the server, just like send_download_to_client.  We wait for
+# more of the file in a worker thread so the event loop is free for other
+# clients in the meantime.
+
+async def send_download_to_stream(writer, code, download, content_header, offset, count, keep_alive):
+
+    file_to_send = download.open()
+    if (file_to_send is None):
+        print('Download from the server failed ... responding with error!')
+        writer.write(prepare_bad_gateway_response(keep_alive))
+        await writer.drain()
+        return
+
+    with file_to_send:
+        header = prepare_response_header(code, content_header, keep_alive)
+        writer.write(header.encode())
+        end = offset + count
+        while (offset < end):
+            received = await asyncio.to_thread(download.wait, offset)
+            if (received is None):
+                raise ConnectionError('download from the server failed')
+            received = min(received, end)
+            await asyncio.get_running_loop().sendfile(writer.transport, file_to_send, offset, received - offset)
+            offset = received
+
+# A function for creating HTTP GET messages.  If we are given the validators
+# of our copy of the file, we make it a conditional GET.  Any extra header
+# lines we are given, such as a Range header, are added on the end.
+
+def prepare_get_message(host, port, file_name, last_modified='', etag='', extra=''):
+    request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n'
+    if last_modified!='':
+        request += f'If-Modified-Since: {last_modified}\r\n'
+    if etag!='':
+        request += f'If-None-Match: {etag}\r\n'
+    return request + extra + '\r\n'
+
+# A buffered reader wrapped around a connected socket.  Rather than pulling a
+# single byte at a time off the socket, we read whatever is available into a
+# reusable buffer and split lines out of that.  Anything left over once the
+# headers are done is handed back first when the body is read.
+
+class SocketReader:
+
+    def __init__(self, sock, data=b''):
+        self.sock = sock
+        self.buffer = bytearray(data)
+        self.chunk = bytearray(READ_BUFFER_SIZE)
+        self.view = memoryview(self.chunk)
+
+    # Read more data from the socket into our buffer.  Returns the number of
+    # bytes read, which will be 0 once the other side closes the connection.
+
+    def fill(self):
+        count = self.sock.recv_into(self.chunk)
+        self.buffer += self.view[:count]
+        return count
+
+    # Read a single line (ending with \r\n) and return it.  We will strip out
+    # the \r and the \n in the process.  Bytes that aren't valid UTF-8 are
+    # replaced rather than failing, so a garbled request is just one we can't
+    # find the file for, not one that takes us down.
+
+    def get_line(self):
+        start = 0
+        while True:
+            index = self.buffer.find(b'\r\n', start)
+            if (index >= 0):
+                line = self.buffer[:index].decode(errors='replace')
+                del self.buffer[:index + 2]
+                return line
+            start = max(len(self.buffer) - 1, 0)
+            if (self.fill() == 0):
+                line = self.buffer.decode(errors='replace')
+                self.buffer.clear()
+                return line
+
+    # Read up to size bytes of a message body, returning anything still in our
+    # buffer before going back to the socket.
+
+    def recv(self, size):
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        return self.sock.recv(size)
 
 # Get the file recieved from server, check if the file is sent or an error occured.
 # If an error occured, add each line up to form an error http header and return the size of the error html message and the header
-# If file received successully, simply return the size of file and empty string since the header doesn't matter in this case. 
+# If file (or part of it, for a 206) received successully, simply return the size of file and empty string since the header doesn't matter in this case. 
+# Either way we also return whether the server will keep the connection open,
+# and a dictionary of the headers keyed by their names in lower case.
+# The Connection header is left out of the error header since it only applies
+# to our connection with the server.
 
-def process_file_recieved(code, line, sock, header_done):
+def process_file_recieved(code, line, reader, header_done):
     bytes_to_read=0
-    if code != '200':
+    keep_alive = True
+    headers = {}
+    if ((code != '200') and (code != '206')):
         print('Error:  An error response was received from the server.  Details:\n')
         message = line+'\r\n'
-        while (not header_done):
-            
-            header_line = get_line_from_socket(sock)
-            message+=header_line+'\r\n'
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                header_done = True
-                message+='\r\n'
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
-        return [bytes_to_read, message]
     else:
         print('Success:  Server is sending file.  Downloading it now.')
-        while (not header_done):
-            header_line = get_line_from_socket(sock)
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                header_done = True
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
+        message = ''
+    while (not header_done):
+        header_line = reader.get_line()
+        header_list = header_line.split(' ')
+        if (header_line == ''):
+            header_done = True
+        else:
+            name, _, value = header_line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+            if (header_list[0] == 'Connection:'):
+                keep_alive = (header_list[1] != 'close')
+            else:
+                if (header_list[0] == 'Content-Length:'):
+                    bytes_to_read = int(header_list[1])
+                if ((code != '200') and (code != '206')):
+                    message+=header_line+'\r\n'
     print(bytes_to_read)
-    return [bytes_to_read,'']
+    return [bytes_to_read, message, keep_alive, headers]
 
 # Read a file from the socket and save it out.
 
-def save_file_from_socket(sock, bytes_to_read, file_name):
+def save_file_from_socket(reader, bytes_to_read, file_name):
     with open(file_name, 'wb') as file_to_write:
         bytes_read = 0
         while (bytes_read < bytes_to_read):
-            chunk = sock.recv(BUFFER_SIZE)
+            chunk = reader.recv(min(BUFFER_SIZE, bytes_to_read - bytes_read))
+            if (not chunk):
+                raise ConnectionError('server closed the connection')
             bytes_read += len(chunk)
             file_to_write.write(chunk)
 
-# main function
-
-def main():
-
-     # Register our signal handler for shutting down.
-    
-    signal.signal(signal.SIGINT, signal_handler)
-
-    # Create the socket.  We will ask this to work on any interface and to pick
-    # a free port at random.  We'll print this out for clients to use.
-
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('', 0))
-    print('Will wait for client connections at port ' + str(server_socket.getsockname()[1]))
-    server_socket.listen(1)
-
-    # Keep the server running forever
-
-    while(1):
-        print('Waiting for incoming client connection ...')
-        conn, addr = server_socket.accept()
-        print('Accepted connection from client address:', addr)
-        print('Connection to client established, waiting to receive message...')
+# Make a temporary file to download a file into, next to where it will be kept
+# in the cache so it can be renamed into place, and return its name.  Every
+# download gets one of its own, so two downloads of the same file at once
+# can't write over each other.  The name ends in .download so anything left
+# behind is cleaned up when we start up again.
 
-        # We obtain our request from the socket.  We look at the request and
-        # figure out what to do based on the contents of things.
-
-        request = get_line_from_socket(conn)
-        print('Received request:  ' + request)
+def make_download_file(file_path):
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(file_path) + '.', suffix='.download', dir=os.path.dirname(file_path))
+    os.close(fd)
+    return temp_path
+
+# Read a file from the socket into memory and return it.
+
+def read_file_from_socket(reader, bytes_to_read):
+    body = bytearray()
+    while (len(body) < bytes_to_read):
+        chunk = reader.recv(min(SEND_BUFFER_SIZE, bytes_to_read - len(body)))
+        if (not chunk):
+            raise ConnectionError('server closed the connection')
+        body += chunk
+    return bytes(body)
+
+# Read a request from the client.  We return the request line along with a
+# dictionary of its headers, keyed by their names in lower case.
+
+def read_request(reader):
+
+    request = reader.get_line()
+    headers = {}
+    header_line = reader.get_line()
+    while (header_line != ''):
+        name, _, value = header_line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+        header_line = reader.get_line()
+    return request, headers
+
+# Read a request from a stream in the asyncio mode.  We wait for the whole
+# request to arrive and then parse it the same way as the serial mode does.
+
+async def read_request_async(stream):
+
+    try:
+        head = await stream.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        return '', {}
+    return read_request(SocketReader(None, head))
+
+# Work out where a file from the given server is kept in the cache, creating
+# its directory if need be.  We return that path along with the name of the
+# file to request from the server.
+
+def get_cache_path(host, port, req_file):
+
+    # create a path with the host and port name
+
+    file_path = host + '_' + str(port) + '/' + req_file.lstrip('/')
+
+    # check if dir exists, if not, create it
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    # get only the file name
+
+    return file_path, req_file.split('/')[-1]
+
+# A pool of open connections to servers, kept by host:port, so that requests to
+# the same server can reuse a connection rather than connecting all over again.
+
+class ConnectionPool:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    # Get a connection to the given server, reusing an idle one if we have one.
+    # We return the socket, a reader for it, and whether it was reused.  New
+    # connections get CONNECT_TIMEOUT to connect and then SERVER_TIMEOUT for
+    # each read, so a server that won't answer can't hold us up for good.
+
+    def get(self, host, port):
+        key = host + ':' + str(port)
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                client_socket, server_reader, idle_since = connections.pop()
+                if (time.monotonic() - idle_since < POOL_IDLE_TIMEOUT):
+                    return client_socket, server_reader, True
+                client_socket.close()
+        client_socket = socket.create_connection((host, port), CONNECT_TIMEOUT)
+        client_socket.settimeout(SERVER_TIMEOUT)
+        return client_socket, SocketReader(client_socket), False
+
+    # Hand back a connection we are done with so it can be reused.
+
+    def put(self, host, port, client_socket, server_reader):
+        key = host + ':' + str(port)
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if (len(connections) < MAX_IDLE_CONNECTIONS):
+                connections.append((client_socket, server_reader, time.monotonic()))
+                return
+        client_socket.close()
+
+server_pool = ConnectionPool()
+
+# An in-memory tier in front of the files in the cache, so that files asked for
+# often are sent straight from memory instead of being opened and read from
+# disk every time.  Files are kept by their path in the cache, along with the
+# record in the index they were read for and their content headers, worked out
+# once when they are loaded.  The least recently used ones are dropped once we
+# hold more than capacity bytes.
+#
+# Every change to a file in the cache must go through here, after the file and
+# its record have been changed, so we never hand out a copy that is out of
+# date.  Each change counts as a new generation.  A file read from disk while
+# the generation changes may not be the one its record describes, so it is
+# thrown away rather than kept.
+
+class MemoryCache:
+
+    def __init__(self, capacity):
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.size = 0
+        self.entries = OrderedDict()
+        self.generation = 0
+
+    # Get the content headers and contents of a file with the given record,
+    # marking it as the most recently used, or None if we don't have that copy
+    # of the file in memory.
+
+    def get(self, file_path, record):
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if ((entry is None) or (entry[0] is not record)):
+                return None
+            self.entries.move_to_end(file_path)
+            return entry[1:]
+
+    # Read a file with the given record from the cache on disk into memory and
+    # return its content headers and contents.  We return None if the file is
+    # too big to keep in memory, has gone, or was changed while we read it.
+
+    def load(self, file_path, record):
+        if (record['size'] > min(MAX_MEMORY_OBJECT_SIZE, self.capacity)):
+            return None
+        with self.lock:
+            generation = self.generation
+        try:
+            with open(file_path, 'rb') as file_to_read:
+                body = file_to_read.read()
+        except FileNotFoundError:
+            return None
+        if (len(body) != record['size']):
+            return None
+        content_header = prepare_cached_header(record)
+        with self.lock:
+            if (self.generation != generation):
+                return None
+            self.discard(file_path)
+            self.entries[file_path] = (record, content_header, body)
+            self.size += len(body)
+            while (self.size > self.capacity):
+                old_path, old_entry = self.entries.popitem(last=False)
+                self.size -= len(old_entry[2])
+        return content_header, body
+
+    # Forget about a file, as it is being removed or replaced on disk.
+
+    def remove(self, file_path):
+        with self.lock:
+            self.generation += 1
+            self.discard(file_path)
+
+    # Drop a file's contents, if we have them.  The lock must already be held.
+
+    def discard(self, file_path):
+        entry = self.entries.pop(file_path, None)
+        if (entry is not None):
+            self.size -= len(entry[2])
+
+memory_cache = MemoryCache(MEMORY_CACHE_SIZE * 1024 * 1024)
+
+# An index of the files kept in the cache on disk.  For each file we keep a
+# record of its size, its content type, when we fetched it or last checked it
+# with the server, how long it stays fresh for, the validators the server gave
+# us for it, how many times it has been asked for, and its priority under the
+# eviction policy.  Looking a file up is then a single
+# dictionary lookup, with no need to check the file on disk.
+#
+# The index is also used to keep the cache within a given number of bytes and
+# files, dropping files according to the eviction policy:
+#
+#   lru:   drop the file used least recently
+#   lfu:   drop the file used least often, least recently used first on a tie
+#   gdsf:  GreedyDual-Size-Frequency, which favours keeping small files that
+#          are used often, and ages files out as others are dropped
+#
+# Files are kept in a heap by priority so the next one to drop is found without
+# looking through them all.  Rather than moving a file within the heap each time
+# it is used, we push it again with its new priority and skip over the out of
+# date copies as they come up.
+#
+# Every change to the index is appended to the index file as a line of JSON,
+# and played back when we start up again, so we come back up with the cache as
+# we left it.  Uses of files, which happen on every hit, are counted up in
+# memory instead and written out every INDEX_FLUSH_INTERVAL seconds, or sooner
+# if some other change is written first, so a hit never waits on the disk.
+# The index file is rewritten with just the current records when we start up
+# and whenever it has grown too long.
+
+class DiskCache:
+
+    def __init__(self, max_size, max_entries, policy):
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.policy = policy
+        self.size = 0
+        self.entries = {}
+        self.heap = []
+        self.clock = 0
+        self.inflation = 0.0
+        self.index_file = None
+        self.index_lines = 0
+        self.pending_hits = OrderedDict()
+
+    # Work out the priority of a file of the given size that has been asked for
+    # the given number of times.  Lower priorities are dropped first.  The lock
+    # must already be held.
+
+    def priority(self, size, hits):
+        self.clock += 1
+        if (self.policy == 'lfu'):
+            return (hits, self.clock)
+        elif (self.policy == 'gdsf'):
+            return (self.inflation + hits / max(size, 1), self.clock)
+        else:
+            return (self.clock,)
+
+    # Get the record for a file in the cache, or None if we don't have it.
+
+    def lookup(self, file_path):
+        with self.lock:
+            return self.entries.get(file_path)
+
+    # Note that a file in the cache was used again.  The use is only written to
+    # the index file later, along with any others, in the order the files were
+    # last used.
+
+    def touch(self, file_path):
+        with self.lock:
+            if (self.hit(file_path) and (self.index_file is not None)):
+                self.pending_hits[file_path] = self.pending_hits.pop(file_path, 0) + 1
+
+    # Add a file that was just saved to the cache, dropping others if that takes
+    # us over our limits.  We return the new record for the file.
+
+    def add(self, file_path, size, content_type, last_modified, etag, freshness):
+        record = {'size': size, 'type': content_type, 'fetched': time.time(), 'modified': last_modified, 'etag': etag, 'hits': 0}
+        record['max_age'], record['swr'], record['sie'] = freshness
+        with self.lock:
+            self.insert(file_path, record)
+            self.log({'op': 'add', 'path': file_path, 'record': record})
+            self.evict(file_path)
+        return record
+
+    # Note that the server told us our copy of a file is still good, so it is
+    # fresh again for as long as the server now says.  We return the file's
+    # record, or None if it has been dropped in the meantime.
+
+    def refresh(self, file_path, freshness):
+        with self.lock:
+            record = self.entries.get(file_path)
+            if (record is not None):
+                record['fetched'] = time.time()
+                record['max_age'], record['swr'], record['sie'] = freshness
+                self.log({'op': 'refresh', 'path': file_path, 'fetched': record['fetched'], 'freshness': freshness})
+            return record
+
+    # Forget about a file, as it is being removed or replaced on disk.
+
+    def remove(self, file_path):
+        with self.lock:
+            if (self.discard(file_path)):
+                self.log({'op': 'remove', 'path': file_path})
+
+    # Put a record for a file into the index, counting it as used once.  The
+    # lock must already be held.
+
+    def insert(self, file_path, record):
+        self.discard(file_path)
+        self.entries[file_path] = record
+        self.size += record['size']
+        self.hit(file_path)
+
+    # Count a use of a file and update its priority, returning whether we have
+    # the file at all.  The lock must already be held.
+
+    def hit(self, file_path):
+        record = self.entries.get(file_path)
+        if (record is None):
+            return False
+        record['hits'] += 1
+        record['priority'] = self.priority(record['size'], record['hits'])
+        self.push(file_path, record)
+        return True
+
+    # Drop a file's record, returning whether we had one.  The lock must
+    # already be held.
+
+    def discard(self, file_path):
+        record = self.entries.pop(file_path, None)
+        if (record is None):
+            return False
+        self.size -= record['size']
+        return True
+
+    # Push a file onto the heap with its current priority, rebuilding the heap
+    # if it has collected too many out of date copies.  The lock must already be
+    # held.
+
+    def push(self, file_path, record):
+        heapq.heappush(self.heap, (record['priority'], file_path))
+        if (len(self.heap) > 2 * len(self.entries) + 64):
+            self.heap = [(item['priority'], path) for path, item in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    # Remove files from the cache until we are within our limits again, never
+    # removing the file we were asked to keep.  The lock must already be held.
+
+    def evict(self, keep=None):
+        kept = []
+        while (((self.size > self.max_size) or (len(self.entries) > self.max_entries)) and self.heap):
+            priority, file_path = heapq.heappop(self.heap)
+            record = self.entries.get(file_path)
+            if ((record is None) or (record['priority'] != priority)):
+                continue
+            if (file_path == keep):
+                kept.append((priority, file_path))
+                continue
+            if (self.policy == 'gdsf'):
+                self.inflation = priority[0]
+            self.discard(file_path)
+            self.log({'op': 'remove', 'path': file_path})
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            memory_cache.remove(file_path)
+            print('Evicted ' + file_path + ' from the cache.')
+        for item in kept:
+            heapq.heappush(self.heap, item)
+
+    # Append a change to the index file, rewriting the file once it has grown
+    # to several times the number of files we have.  The lock must already be
+    # held.
+
+    def log(self, change):
+        if (self.index_file is None):
+            return
+        self.write_hits()
+        self.index_file.write(json.dumps(change) + '\n')
+        self.index_file.flush()
+        self.index_lines += 1
+        if (self.index_lines > 4 * len(self.entries) + 1000):
+            self.compact()
+
+    # Write out the uses of files we have counted up since we last did, a line
+    # for each file giving how many times it was used.  The caller flushes the
+    # index file.  The lock must already be held.
+
+    def write_hits(self):
+        for file_path, count in self.pending_hits.items():
+            self.index_file.write(json.dumps({'op': 'hit', 'path': file_path, 'count': count}) + '\n')
+        self.index_lines += len(self.pending_hits)
+        self.pending_hits.clear()
+
+    # Write out the uses of files we have counted up every INDEX_FLUSH_INTERVAL
+    # seconds, for good.
+
+    def run_flush(self):
+        while True:
+            time.sleep(INDEX_FLUSH_INTERVAL)
+            with self.lock:
+                if ((self.index_file is not None) and self.pending_hits):
+                    self.write_hits()
+                    self.index_file.flush()
+                    if (self.index_lines > 4 * len(self.entries) + 1000):
+                        self.compact()
+
+    # Rewrite the index file with a single record for each file we have, going
+    # through a temporary file so a crash part way leaves the old one in place.
+    # Files are written in order of priority so that playing them back gives
+    # the same order again.  The lock must already be held.
+
+    def compact(self):
+        if (self.index_file is not None):
+            self.index_file.close()
+        self.pending_hits.clear()
+        temp_name = INDEX_FILE + '.tmp'
+        with open(temp_name, 'w') as index_file:
+            for priority, file_path in sorted((record['priority'], path) for path, record in self.entries.items()):
+                index_file.write(json.dumps({'op': 'add', 'path': file_path, 'record': self.entries[file_path]}) + '\n')
+        os.replace(temp_name, INDEX_FILE)
+        self.index_file = open(INDEX_FILE, 'a')
+        self.index_lines = len(self.entries)
+
+    # Load the index when we start up.  If we have an index file we play it
+    # back; otherwise we build the index from the files already in the cache,
+    # oldest first.  Either way we then drop files if we are over our limits
+    # and write out a fresh index file, and start writing out uses of files
+    # in the background.
+
+    def load(self):
+        with self.lock:
+            if (os.path.exists(INDEX_FILE)):
+                self.replay()
+            else:
+                self.scan()
+            self.evict()
+            self.compact()
+        threading.Thread(target=self.run_flush, daemon=True).start()
+        print('Loaded ' + str(len(self.entries)) + ' files (' + str(self.size) + ' bytes) into the cache index.')
+
+    # Play back the changes in the index file.  Hit counts and priorities are
+    # worked out again as we go, so they follow the current eviction policy.
+    # The lock must already be held.
+
+    def replay(self):
+        with open(INDEX_FILE) as index_file:
+            for line in index_file:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    continue
+                if (change['op'] == 'add'):
+                    record = change['record']
+                    hits = record['hits']
+                    record['hits'] = 0
+                    record.setdefault('etag', '')
+                    record.setdefault('max_age', DEFAULT_MAX_AGE)
+                    record.setdefault('swr', DEFAULT_STALE_WHILE_REVALIDATE)
+                    record.setdefault('sie', DEFAULT_STALE_IF_ERROR)
+                    self.insert(change['path'], record)
+                    for i in range(hits - 1):
+                        self.hit(change['path'])
+                elif (change['op'] == 'hit'):
+                    for i in range(change.get('count', 1)):
+                        self.hit(change['path'])
+                elif ((change['op'] == 'refresh') and (change['path'] in self.entries)):
+                    record = self.entries[change['path']]
+                    record['fetched'] = change['fetched']
+                    record['max_age'], record['swr'], record['sie'] = change['freshness']
+                elif (change['op'] == 'remove'):
+                    self.discard(change['path'])
+
+    # Build the index from the files already in the cache, clearing out any
+    # downloads left unfinished.  The lock must already be held.
+
+    def scan(self):
+        found = []
+        for directory in os.scandir('.'):
+            if ((not directory.is_dir()) or (directory.name == CHUNK_DIR)):
+                continue
+            for root, dirs, files in os.walk(directory.name):
+                for name in files:
+                    file_path = os.path.join(root, name)
+                    if (name.endswith('.download')):
+                        os.remove(file_path)
+                        continue
+                    stat = os.stat(file_path)
+                    found.append((stat.st_mtime, file_path, stat.st_size))
+        for mtime, file_path, size in sorted(found):
+            self.insert(file_path, {'size': size, 'type': get_content_type(file_path), 'fetched': mtime, 'modified': '', 'etag': '', 'hits': 0,
+                                    'max_age': DEFAULT_MAX_AGE, 'swr': DEFAULT_STALE_WHILE_REVALIDATE, 'sie': DEFAULT_STALE_IF_ERROR})
+
+disk_cache = DiskCache(CACHE_SIZE * 1024 * 1024, MAX_CACHE_ENTRIES, EVICTION_POLICY)
+
+# The parts we have of large files that clients only asked for ranges of, so a
+# client fetching a huge file a piece at a time, or resuming a download of one,
+# doesn't make us fetch the whole file first.  Each file's parts are written at
+# their own offsets into a sparse file of their own in CHUNK_DIR, and we keep a
+# sorted list of the ranges of bytes we have of it, merging them as more
+# arrive.  Files whose validators change start over with a new sparse file.
+# The least recently used files are dropped once we hold more than capacity
+# bytes of parts.  None of this is kept across restarts.
+
+class ChunkCache:
+
+    def __init__(self, capacity):
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.size = 0
+        self.count = 0
+        self.entries = OrderedDict()
+
+    # Clear out any parts left over from before we started.
+
+    def clear(self):
+        shutil.rmtree(CHUNK_DIR, ignore_errors=True)
+        os.makedirs(CHUNK_DIR)
+
+    # Look for the range of a file a client asked for among the parts we have
+    # of it.  If they hold the whole range and are still fresh we return the
+    # response to send back, just like get_response does; otherwise None.
+
+    def get(self, file_path, headers):
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if ((entry is None) or (time.time() - entry['fetched'] >= entry['max_age'])):
+                return None
+            byte_range = parse_range(headers, entry['size'], entry['modified'], entry['etag'])
+            if (not byte_range):
+                return None
+            first, last = byte_range
+            if (not any(((start <= first) and (last < end)) for start, end in entry['ranges'])):
+                return None
+            self.entries.move_to_end(file_path)
+        print('Requested range is in the cache, sending it back...')
+        content_header = prepare_partial_header(entry['type'], first, last, entry['size']) + prepare_validator_header(entry['modified'], entry['etag'])
+        return ['206', entry['path'], content_header, None, None, first, last - first + 1]
+
+    # Save a part of a file coming from the server, count bytes of it starting
+    # at offset first.  The part is written to the file's sparse file as it
+    # arrives, and only added to the ranges we have once it is all there.  We
+    # return the path of the sparse file to send the part back from.
+
+    def save(self, file_path, reader, first, count, total, content_type, last_modified, etag, freshness):
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if ((entry is None) or (entry['size'] != total) or (entry['modified'] != last_modified) or (entry['etag'] != etag)):
+                self.discard(file_path)
+                self.count += 1
+                entry = {'path': CHUNK_DIR + '/' + str(self.count) + '.chunk', 'size': total, 'type': content_type,
+                         'modified': last_modified, 'etag': etag, 'ranges': [], 'stored': 0}
+                self.entries[file_path] = entry
+            entry['fetched'] = time.time()
+            entry['max_age'] = freshness[0]
+            fd = os.open(entry['path'], os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            offset = first
+            while (offset < first + count):
+                chunk = reader.recv(min(SEND_BUFFER_SIZE, first + count - offset))
+                if (not chunk):
+                    raise ConnectionError('server closed the connection')
+                offset += os.pwrite(fd, chunk, offset)
+        finally:
+            os.close(fd)
+        with self.lock:
+            if (self.entries.get(file_path) is entry):
+                self.merge(entry, first, first + count)
+                self.entries.move_to_end(file_path)
+                self.evict(file_path)
+        return entry['path']
+
+    # Forget about the parts of a file, as we now have all of it.
+
+    def remove(self, file_path):
+        with self.lock:
+            self.discard(file_path)
+
+    # Add the bytes from start up to end to the ranges we have of a file,
+    # merging any it overlaps or touches.  The lock must already be held.
+
+    def merge(self, entry, start, end):
+        ranges = []
+        for old_start, old_end in entry['ranges']:
+            if ((old_end < start) or (old_start > end)):
+                ranges.append((old_start, old_end))
+            else:
+                start, end = min(start, old_start), max(end, old_end)
+        ranges.append((start, end))
+        ranges.sort()
+        stored = sum(end - start for start, end in ranges)
+        self.size += stored - entry['stored']
+        entry['ranges'] = ranges
+        entry['stored'] = stored
+
+    # Drop files until we hold no more than capacity bytes, never dropping the
+    # file we were asked to keep.  The lock must already be held.
+
+    def evict(self, keep):
+        for file_path in list(self.entries):
+            if (self.size <= self.capacity):
+                break
+            if (file_path != keep):
+                self.discard(file_path)
 
-        # We obtain the second line in message which contains the host and port info of the server
+    # Drop the parts of a file, if we have any.  The lock must already be held.
 
-        info = get_line_from_socket(conn)
-        host = info.split(' ')[1].split(':')[0]
-        port = int(info.split(' ')[1].split(':')[1])
-        
-        # Now try to make connection to server
+    def discard(self, file_path):
+        entry = self.entries.pop(file_path, None)
+        if (entry is None):
+            return
+        self.size -= entry['stored']
+        try:
+            os.remove(entry['path'])
+        except FileNotFoundError:
+            pass
 
+chunk_cache = ChunkCache(CHUNK_CACHE_SIZE * 1024 * 1024)
+
+# Collapses requests for the same file made at the same time into one.  The
+# first request for a file does the work, and any that come in for the same
+# file while it is at it wait for it to finish and share its result, so that
+# however many clients ask for a file at once we only go to the server once.
+
+class SingleFlight:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    # Call function with the given arguments on behalf of everyone asking for
+    # key at the moment, returning its result (or raising its error) to each.
+
+    def run(self, key, function, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = (flight is None)
+            if leader:
+                flight = {'done': threading.Event(), 'result': None, 'error': None}
+                self.flights[key] = flight
+        if (not leader):
+            print('Waiting on the request already being made for ' + key)
+            flight['done'].wait()
+            if (flight['error'] is not None):
+                raise flight['error']
+            return flight['result']
+        try:
+            flight['result'] = function(*args)
+        except BaseException as error:
+            flight['error'] = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight['done'].set()
+        return flight['result']
+
+in_flight = SingleFlight()
+
+# Checks stale files with the server in the background, so clients can be sent
+# the stale copy straight away rather than waiting on the server.  Files are
+# queued up for a few worker threads to check, each file only once at a time,
+# and the checks go through in_flight along with any requests for the same file.
+
+class Revalidator:
+
+    def __init__(self, workers):
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.threads = []
+        self.pending = set()
+        self.queue = queue.Queue()
+
+    # Queue a file to be checked with the server, unless it already is.  The
+    # worker threads are started the first time they are needed.
+
+    def add(self, host, port, req_file, file_path):
+        with self.lock:
+            if (file_path in self.pending):
+                return
+            self.pending.add(file_path)
+            while (len(self.threads) < self.workers):
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put((host, port, req_file, file_path))
+
+    # Check queued files with the server, one after another, for good.  A check
+    # that goes wrong in any way, such as a response from the server we can't
+    # make sense of, is only logged, so the worker carries on with the rest.
+
+    def run(self):
+        while True:
+            host, port, req_file, file_path = self.queue.get()
+            try:
+                in_flight.run(file_path, fetch_response, host, port, req_file, file_path, disk_cache.lookup(file_path))
+            except OSError as error:
+                print('Error:  Checking ' + file_path + ' with the server failed:', error)
+            except Exception as error:
+                print('Error:  Checking ' + file_path + ' with the server failed:', repr(error))
+            finally:
+                with self.lock:
+                    self.pending.discard(file_path)
+
+revalidator = Revalidator(REVALIDATE_WORKERS)
+
+# A file being downloaded from the server in tee mode.  The download runs in a
+# thread of its own, writing the file to a temporary file next to where it will
+# be kept in the cache, while any number of clients send it on as it arrives.
+# Once it is all here the file is renamed into place and added to the index.
+# Clients read the temporary file through their own handles on it, which keep
+# working after it has been renamed.
+
+class Download:
+
+    def __init__(self, file_path, size, content_type, last_modified, etag, freshness):
+        self.file_path = file_path
+        self.temp_path = make_download_file(file_path)
+        self.size = size
+        self.content_type = content_type
+        self.last_modified = last_modified
+        self.etag = etag
+        self.freshness = freshness
+        self.record = {'size': size, 'type': content_type, 'modified': last_modified, 'etag': etag}
+        self.content_header = prepare_content_header(content_type, size) + prepare_validator_header(last_modified, etag)
+        self.file = open(self.temp_path, 'wb+', buffering=0)
+        self.received = 0
+        self.finished = False
+        self.failed = False
+        self.condition = threading.Condition()
+
+    # Start downloading the file from the server in the background.
+
+    def start(self, host, port, client_socket, server_reader, keep_alive):
+        with downloads_lock:
+            active_downloads[self.file_path] = self
+        thread = threading.Thread(target=self.run, args=(host, port, client_socket, server_reader, keep_alive), daemon=True)
+        thread.start()
+
+    # Read the file from the server, letting waiting clients know as each part
+    # arrives.  When we are done we hand the connection back to the pool.
+
+    def run(self, host, port, client_socket, server_reader, keep_alive):
+        try:
+            while (self.received < self.size):
+                chunk = server_reader.recv(min(SEND_BUFFER_SIZE, self.size - self.received))
+                if (not chunk):
+                    raise ConnectionError('server closed the connection')
+                self.write(chunk, self.received)
+                with self.condition:
+                    self.received += len(chunk)
+                    self.condition.notify_all()
+            chunk_cache.remove(self.file_path)
+            os.replace(self.temp_path, self.file_path)
+            disk_cache.add(self.file_path, self.size, self.content_type, self.last_modified, self.etag, self.freshness)
+            memory_cache.remove(self.file_path)
+        except OSError as error:
+            print('Error:  Download of ' + self.file_path + ' failed:', error)
+            client_socket.close()
+            self.failed = True
+            try:
+                os.remove(self.temp_path)
+            except FileNotFoundError:
+                pass
+        else:
+            if keep_alive:
+                server_pool.put(host, port, client_socket, server_reader)
+            else:
+                client_socket.close()
+        finally:
+            with downloads_lock:
+                del active_downloads[self.file_path]
+            with self.condition:
+                self.finished = True
+                self.file.close()
+                self.condition.notify_all()
+
+    # Write a chunk of the file at the given offset.  We always say where to
+    # write rather than going by the file's position, so nothing the clients
+    # reading the file do can move us.
+
+    def write(self, chunk, offset):
+        view = memoryview(chunk)
+        while view:
+            written = os.pwrite(self.file.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+
+    # Open the file being downloaded for reading, or return None if the
+    # download has failed.  Each client gets a file of its own, with its own
+    # position in it, since sending a file moves that position.  Once the
+    # download is done the file has been moved into place in the cache, so we
+    # open it there, making sure it is still the file we downloaded.
+
+    def open(self):
+        with self.condition:
+            if self.failed:
+                return None
+            if (not self.finished):
+                try:
+                    return open(self.temp_path, 'rb')
+                except FileNotFoundError:
+                    pass
+            try:
+                file_to_send = open(self.file_path, 'rb')
+            except FileNotFoundError:
+                return None
+            if (os.fstat(file_to_send.fileno()).st_size != self.size):
+                file_to_send.close()
+                return None
+            return file_to_send
+
+    # Wait until more of the file than the given offset has arrived, returning
+    # how much of it we have, or None if the download failed.
+
+    def wait(self, offset):
+        with self.condition:
+            while ((self.received <= offset) and (not self.finished)):
+                self.condition.wait()
+            if self.failed:
+                return None
+            return self.received
+
+active_downloads = {}
+downloads_lock = threading.Lock()
+
+# Send a request to the server over a pooled connection and read the status
+# line of its response.  If a connection we reused turns out to have been
+# closed by the server in the meantime, we try again on a new one.  A server
+# that takes too long to answer is not tried again.  We return the socket, its
+# reader and the status line, or None if the server could not be reached.
+
+def send_to_server(host, port, message):
+
+    while True:
         try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((host, port))
-            
-        except ConnectionRefusedError:
+            client_socket, server_reader, reused = server_pool.get(host, port)
+        except OSError:
             print('Error:  That host or port is not accepting connections.')
-            sys.exit(1)
-
-        request_list = request.split()
+            return None
+        try:
+            client_socket.sendall(message.encode())
+            response_line = server_reader.get_line()
+        except socket.timeout:
+            print('Error:  The server took too long to answer.')
+            client_socket.close()
+            return None
+        except OSError:
+            response_line = ''
+        if (response_line != ''):
+            return client_socket, server_reader, response_line
+        client_socket.close()
+        if (not reused):
+            print('Error:  The server closed the connection.')
+            return None
+
+# Get a file through the cache.  A file we have that is still fresh is sent
+# back without asking the server about it at all.  One that has gone stale but
+# not for too long is sent back straight away too, and checked with the server
+# in the background for next time.  Otherwise we have to go to the server for
+# it before we can send anything back.  We return the response code along with
+# the path of the file in the cache to send back, its content headers, its
+# contents if we have them in memory and its download if it is still on its way
+# from the server in tee mode (for a 200), or the header and body of the
+# server's response to pass back to the client (for errors).  We return None if
+# the server could not be reached.  Whether we have the file and how old it is
+# come from the cache index, so we never need to look at the file on disk for
+# that.
+
+def get_response(host, port, req_file, file_path):
+
+    # If the file is already being downloaded, send it on from that download.
+
+    with downloads_lock:
+        download = active_downloads.get(file_path)
+    if download is not None:
+        return ['200', file_path, download.content_header, None, download]
+
+    record = disk_cache.lookup(file_path)
+
+    # file does not exist, go and get it from the server
+
+    if record is None:
+        print("no file")
+        return fetch_response(host, port, req_file, file_path, None)
+
+    # file exists, see how long ago we fetched it or last checked it
+
+    disk_cache.touch(file_path)
+    age = time.time() - record['fetched']
+    print('file exists')
+
+    if age < record['max_age']:
+        print('file is fresh, sending it back...')
+        return cached_response(file_path, record)
+
+    if age < record['max_age'] + record['swr']:
+        print('file is stale, sending it back while it is checked with the server...')
+        revalidator.add(host, port, req_file, file_path)
+        return cached_response(file_path, record)
+
+    # file is too stale to send back without checking it with the server first
+
+    print('file is stale, checking it with the server...')
+    return fetch_response(host, port, req_file, file_path, record)
+
+# Get a file from the server, with a conditional GET if we already have a copy
+# of it in the cache with the given record.  We return the response to send
+# back just like get_response does.  If the server can't be reached or has
+# trouble of its own, we fall back to sending back a stale copy if we have one
+# that isn't too old for that.  Any extra header lines are passed on to the
+# server; we are given a Range header there when a client asks for part of a
+# file we don't have.
+
+def fetch_response(host, port, req_file, file_path, record, extra=''):
+
+    # file does not exist, prepare message and send it to server
+
+    if record is None:
+        message = prepare_get_message(host, port, req_file, extra=extra)
+
+    # file exists, call a conditional GET with the validators the server gave
+    # us, or the time we fetched it if the server didn't give us any.
 
-        
+    else:
+        last_modified = record['modified']
+        etag = record.get('etag', '')
+        if ((not last_modified) and (not etag)):
+            last_modified = formatdate(int(record['fetched']), usegmt=True)
+        message = prepare_get_message(host, port, req_file, last_modified, etag)
 
-        # check if the message is a GET message
-        if request_list[0]=='GET':
+    sent = send_to_server(host, port, message)
+    if (sent is None):
+        return stale_response(file_path, record)
+    client_socket, server_reader, response_line = sent
 
-            # get the file path
+    try:
 
-            req_file = request_list[1]
-            while (req_file[0] == '/'):
+        # get response from server and process it
 
-                # create a path with the host and port name
+        response_list = response_line.split(' ')
+        list_of_message = process_file_recieved(response_list[1], response_line, server_reader, False)
+        headers = list_of_message[3]
 
-                file_path = host+'_'+str(port)+req_file
+        # file in server is older, file in cache is still good and sent to
+        # client, and is fresh again for as long as the server says
 
-                # get only the file name
+        if response_list[1] == '304':
+            print(list_of_message[1])
+            if list_of_message[0] > 0:
+                print_file_from_socket(server_reader, list_of_message[0])
+            record = disk_cache.refresh(file_path, get_freshness(headers))
+            response = None
 
-                req_file = req_file.split('/')[-1]
+        # server is having trouble, so send back our stale copy if we can,
+        # and pass back the error otherwise
 
-            # get the path without the file name
+        elif ((response_list[1] in SERVER_ERRORS) and (usable_if_error(record))):
+            print_file_from_socket(server_reader, list_of_message[0])
+            response = stale_response(file_path, record)
+            record = None
 
-            list_dir = file_path.split('/')
-            dir_path = ''
-            counter =0
-            while counter<len(list_dir)-1:
-                dir_path = dir_path+list_dir[counter]  +'/'  
-                counter+=1
-            
-            dir_path = dir_path.rstrip('/')
-            
-            # check if dir exists, if not, create it
-            if not os.path.isdir(dir_path):
-                os.makedirs(dir_path)
+        # only the part of the file asked for was sent, so pass it on
 
-            
+        elif response_list[1] == '206':
+            response = partial_response(file_path, server_reader, list_of_message[0], headers)
 
-            # file does not exist, prepare message and send it to server
+        # if file not received successfully, remove any local copy and simply
+        # pass back error header and error html content
 
-            if not os.path.exists(file_path):
-                print("no file")
-                
-                message = prepare_get_message(host, port, req_file)
-                client_socket.send(message.encode())
-                
-                # get response from server
+        elif response_list[1] != '200':
+            if record is not None:
+                remove_cached_file(file_path)
+                record = None
+            http_header = print_file_from_socket(server_reader, list_of_message[0])
+            response = [response_list[1], list_of_message[1], http_header]
 
-                response_line = get_line_from_socket(client_socket)
-                response_list = response_line.split(' ')
-                headers_done = False
+        # file received successfully, save file locally, replacing any older
+        # copy, and add it to the index.  In tee mode we leave the file
+        # downloading in the background and start sending it to the client
+        # straight away.
 
-                # process received message
+        else:
+            if record is not None:
+                print("newer file founded...")
+            content_type = headers.get('content-type', get_content_type(file_path))
+            last_modified = headers.get('last-modified', '')
+            etag = headers.get('etag', '')
+            freshness = get_freshness(headers)
+            if TEE_MODE:
+                download = Download(file_path, list_of_message[0], content_type, last_modified, etag, freshness)
+                download.start(host, port, client_socket, server_reader, list_of_message[2])
+                return ['200', file_path, download.content_header, None, download]
+            temp_path = make_download_file(file_path)
+            try:
+                save_file_from_socket(server_reader, list_of_message[0], temp_path)
+            except:
+                os.remove(temp_path)
+                raise
+            chunk_cache.remove(file_path)
+            os.replace(temp_path, file_path)
+            record = disk_cache.add(file_path, list_of_message[0], content_type, last_modified, etag, freshness)
+            memory_cache.remove(file_path)
+
+    except OSError:
+        client_socket.close()
+        response = stale_response(file_path, record)
+        if response is None:
+            raise
+        return response
+
+    except:
+        client_socket.close()
+        raise
+
+    # We are done with the server for now, so keep the connection for next
+    # time if the server is happy to.
+
+    if list_of_message[2]:
+        server_pool.put(host, port, client_socket, server_reader)
+    else:
+        client_socket.close()
+
+    if record is None:
+        return response
+    return cached_response(file_path, record)
+
+# Send back the copy of a file we have in the cache, from memory if we can,
+# bringing it into memory for next time if it isn't there already.  We let the
+# client know how long ago we got it from or checked it with the server.
+
+def cached_response(file_path, record):
+    entry = memory_cache.get(file_path, record)
+    if entry is None:
+        entry = memory_cache.load(file_path, record)
+    if entry is None:
+        content_header, body = prepare_cached_header(record), None
+    else:
+        content_header, body = entry
+    content_header = content_header + 'Age: ' + str(max(int(time.time() - record['fetched']), 0)) + '\r\n'
+    return ['200', file_path, content_header, body, None]
+
+# Send back the range of a file a client asked for out of the whole copy of it
+# we have in the cache with the given record.  We return a 206 with the offset
+# and number of bytes to send from the file in the cache, or the part of it we
+# have in memory, or a 416 if the range lies past the end of the file.  If the
+# range is one we can't handle, we send back the whole file.
+
+def range_response(response, record, headers):
+    byte_range = parse_range(headers, record['size'], record['modified'], record.get('etag', ''))
+    if (byte_range is None):
+        return response
+    if (byte_range is False):
+        print('Requested range is past the end of the file ... responding with error!')
+        return ['416', prepare_unsatisfiable_header(record['size']), b'']
+    first, last = byte_range
+    print('Sending back part of the file...')
+    content_header = prepare_partial_header(record['type'], first, last, record['size']) + prepare_validator_header(record['modified'], record.get('etag', ''))
+    body = response[3]
+    if body is not None:
+        body = body[first:last + 1]
+    return ['206', response[1], content_header, body, response[4], first, last - first + 1]
+
+# Get the range of a file a client asked for when we don't have the whole
+# file, from the parts of it we have if they cover the range, and by passing
+# the Range header (and any If-Range) on to the server otherwise.  If the
+# server sends back the whole file instead, we cache it as usual and send back
+# the range from our copy.
+
+def get_range_response(host, port, req_file, file_path, headers):
+    response = chunk_cache.get(file_path, headers)
+    if response is not None:
+        return response
+    print('Requested range is not in the cache, asking the server for it...')
+    extra = 'Range: ' + headers['range'] + '\r\n'
+    if ('if-range' in headers):
+        extra = extra + 'If-Range: ' + headers['if-range'] + '\r\n'
+    response = fetch_response(host, port, req_file, file_path, None, extra)
+    if ((response is not None) and (response[0] == '200') and (response[4] is None)):
+        record = disk_cache.lookup(file_path)
+        if record is not None:
+            return range_response(response, record, headers)
+    return response
+
+# Pass on a 206 from the server for part of a file we don't have.  Parts of
+# files at least LARGE_OBJECT_SIZE megabytes big are kept among the parts we
+# have of them and sent back from there, while parts of smaller files are just
+# read into memory and passed on, since the whole file is cheap enough to fetch
+# and cache when it is asked for.
+
+def partial_response(file_path, server_reader, bytes_to_read, headers):
+    content_type = headers.get('content-type', get_content_type(file_path))
+    last_modified = headers.get('last-modified', '')
+    etag = headers.get('etag', '')
+    content_range = parse_content_range(headers.get('content-range', ''))
+    if ((content_range is None) or (content_range[1] - content_range[0] + 1 != bytes_to_read) or (content_range[2] < LARGE_OBJECT_SIZE * 1024 * 1024)):
+        content_header = prepare_content_header(content_type, bytes_to_read) + 'Content-Range: ' + headers.get('content-range', '') + '\r\n'
+        content_header = content_header + prepare_validator_header(last_modified, etag)
+        return ['206', file_path, content_header, read_file_from_socket(server_reader, bytes_to_read), None, 0, bytes_to_read]
+    first, last, total = content_range
+    content_header = prepare_partial_header(content_type, first, last, total) + prepare_validator_header(last_modified, etag)
+    chunk_path = chunk_cache.save(file_path, server_reader, first, bytes_to_read, total, content_type, last_modified, etag, get_freshness(headers))
+    return ['206', chunk_path, content_header, None, None, first, bytes_to_read]
+
+# Check whether we have a copy of a file that hasn't been stale for too long to
+# send back when the server can't give us a new one.
+
+def usable_if_error(record):
+    return ((record is not None) and (time.time() - record['fetched'] < record['max_age'] + record['sie']))
+
+# Send back a stale copy of a file when the server can't give us a new one,
+# provided it hasn't been stale for too long.  We return None if we can't.
+
+def stale_response(file_path, record):
+    if (not usable_if_error(record)):
+        return None
+    print('Server could not be reached, sending back stale copy of file...')
+    return cached_response(file_path, record)
+
+# Remove a file from the cache, along with its record in the index and any copy
+# of it in memory.
+
+def remove_cached_file(file_path):
+    disk_cache.remove(file_path)
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+    memory_cache.remove(file_path)
+
+# Check whether the client wants the connection kept open after this request.
+# HTTP/1.1 connections stay open unless the client asks for them to be closed.
+
+def keep_connection_alive(request, headers):
+
+    return ((request.endswith('HTTP/1.1')) and (headers.get('connection', '').lower() != 'close'))
+
+# Look at a request and figure out what to do based on the contents of things.
+# Only GET requests are handled by the cache; we return None for anything else.
+
+def process_request(request, headers):
+
+    request_list = request.split()
+
+    # check if the message is a GET message
+
+    if ((request_list[0] != 'GET') or ('host' not in headers)):
+        print('Invalid request received ... ignoring it!')
+        return None
+
+    # We obtain the host and port info of the server from the Host header
+
+    host = headers['host'].split(':')[0]
+    port = int(headers['host'].split(':')[1])
+
+    # Requests for a file already being fetched wait for that fetch instead of
+    # making their own.
+
+    file_path, req_file = get_cache_path(host, port, request_list[1])
+
+    # If the client only wants part of a file we don't have at all, we get just
+    # that part rather than the whole file.  Requests for the same part of a
+    # file at the same time are collapsed into one.
+
+    with downloads_lock:
+        downloading = (file_path in active_downloads)
+    if ((wants_range(headers)) and (not downloading) and (disk_cache.lookup(file_path) is None)):
+        return in_flight.run(file_path + ' ' + headers['range'], get_range_response, host, port, req_file, file_path, headers)
+
+    response = in_flight.run(file_path, get_response, host, port, req_file, file_path)
+
+    # If the client made a conditional GET and its copy matches ours, we send
+    # back a 304 with just the validators instead of the whole file.  If it
+    # asked for part of the file, we send back just that part.  A file still on
+    # its way from the server in tee mode is checked against what the server
+    # told us about it, as the index still describes any older copy.
+
+    if ((response is not None) and (response[0] == '200')):
+        if (response[4] is not None):
+            record = response[4].record
+        else:
+            record = disk_cache.lookup(file_path)
+        if ((record is not None) and (not_modified(headers, record['modified'], record.get('etag', '')))):
+            print('Client copy is still good ... responding with 304!')
+            return ['304', prepare_validator_header(record['modified'], record.get('etag', ''))]
+        if ((record is not None) and ('range' in headers)):
+            return range_response(response, record, headers)
+    return response
+
+# Serve a single client connection from start to finish using blocking calls.
+# Unless persistent is False, we keep serving requests on the connection for as
+# long as the client wants, closing it if the client goes quiet for IDLE_TIMEOUT.
+
+def serve_client(conn, addr, persistent=True):
+
+    print('Accepted connection from client address:', addr)
+    print('Connection to client established, waiting to receive message...')
+    try:
+        conn.settimeout(IDLE_TIMEOUT)
+        reader = SocketReader(conn)
+        keep_alive = True
+        while keep_alive:
+            request, headers = read_request(reader)
+            if (request == ''):
+                break
+            print('Received request:  ' + request)
+            response = process_request(request, headers)
+            keep_alive = persistent and keep_connection_alive(request, headers)
+            if (response is None):
+                break
+            elif (response[0] == '304'):
+                conn.sendall(prepare_response_header('304', response[1], keep_alive).encode())
+            elif ((response[0] == '200') and (response[4] is not None)):
+                send_download_to_client(conn, '200', response[4], response[2], 0, response[4].size, keep_alive)
+            elif ((response[0] == '206') and (response[4] is not None)):
+                send_download_to_client(conn, '206', response[4], response[2], response[5], response[6], keep_alive)
+            elif ((response[0] == '200') and (response[3] is not None)):
+                send_memory_response_to_client(conn, response[2], response[3], keep_alive)
+            elif (response[0] == '200'):
+                send_response_to_client(conn, '200', response[1], response[2], keep_alive)
+            elif ((response[0] == '206') and (response[3] is not None)):
+                send_memory_response_to_client(conn, response[2], response[3], keep_alive, '206')
+            elif (response[0] == '206'):
+                send_range_response_to_client(conn, response[1], response[2], response[5], response[6], keep_alive)
+            else:
+                conn.sendall(prepare_error_response(response[1], response[2], keep_alive))
+    except TimeoutError:
+        print('Connection to client idle for too long, closing it ...')
+    except OSError as error:
+        print('Error:  Connection to client failed:', error)
+
+    # We are all done with this client, so close the connection.
+
+    finally:
+        conn.close()
+
+# Serve a single client connection in the asyncio mode, for as many requests as
+# the client wants to make on it.  Talking to the server and writing to the
+# cache are done with blocking calls, so we hand them off to a worker thread
+# and keep the event loop free for other clients.
+
+async def serve_client_async(stream, writer):
+
+    print('Accepted connection from client address:', writer.get_extra_info('peername'))
+    try:
+        keep_alive = True
+        while keep_alive:
+            request, headers = await asyncio.wait_for(read_request_async(stream), IDLE_TIMEOUT)
+            if (request == ''):
+                break
+            print('Received request:  ' + request)
+            response = await asyncio.to_thread(process_request, request, headers)
+            keep_alive = keep_connection_alive(request, headers)
+            if (response is None):
+                break
+            elif (response[0] == '304'):
+                writer.write(prepare_response_header('304', response[1], keep_alive).encode())
+                await writer.drain()
+            elif ((response[0] == '200') and (response[4] is not None)):
+                await send_download_to_stream(writer, '200', response[4], response[2], 0, response[4].size, keep_alive)
+            elif ((response[0] == '206') and (response[4] is not None)):
+                await send_download_to_stream(writer, '206', response[4], response[2], response[5], response[6], keep_alive)
+            elif ((response[0] == '200') and (response[3] is not None)):
+                await send_memory_response_to_stream(writer, response[2], response[3], keep_alive)
+            elif (response[0] == '200'):
+                await send_response_to_stream(writer, '200', response[1], response[2], keep_alive)
+            elif ((response[0] == '206') and (response[3] is not None)):
+                await send_memory_response_to_stream(writer, response[2], response[3], keep_alive, '206')
+            elif (response[0] == '206'):
+                await send_range_response_to_stream(writer, response[1], response[2], response[5], response[6], keep_alive)
+            else:
+                writer.write(prepare_error_response(response[1], response[2], keep_alive))
+                await writer.drain()
+    except TimeoutError:
+        print('Connection to client idle for too long, closing it ...')
+    except OSError as error:
+        print('Error:  Connection to client failed:', error)
 
-                list_of_message = process_file_recieved(response_list[1], response_line, client_socket, headers_done)
+    # We are all done with this client, so close the connection.
 
-                # if file not received successfully, simple send error header and error html content
+    finally:
+        writer.close()
 
-                if response_list[1]!='200':
-                    print('Error:  An error response was received from the server.  Details:\n')
-                    print(response_line)
-                    
-                    http_header = print_file_from_socket(client_socket, list_of_message[0])
-                    print("ERROR MESSAGE!!!!!!!!!")
-                    conn.send(list_of_message[1].encode())
-                    conn.send(http_header.encode())
-                    
-                # file received successfully, save file locally and send response to client.
+# Serve every client from a single asyncio event loop.
 
-                else: 
-                    print('Success:  Server is sending file.  Downloading it now.')
+async def run_asyncio(server_socket):
 
-                    # Go through headers and find the size of the file, then save it.
-            
-                    save_file_from_socket(client_socket, list_of_message[0], file_path)
-                    send_response_to_client(conn, '200',file_path)
+    server = await asyncio.start_server(serve_client_async, sock=server_socket, backlog=LISTEN_BACKLOG)
+    print('Waiting for incoming client connections ...')
+    async with server:
+        await server.serve_forever()
 
-            # file exists
+# main function
 
-            else:    
+def main():
 
-                # get current time and modification time of local file
+    global TEE_MODE, DEFAULT_MAX_AGE, DEFAULT_STALE_WHILE_REVALIDATE, DEFAULT_STALE_IF_ERROR, LARGE_OBJECT_SIZE
+
+    # Check command line arguments for how we should handle connections.
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-mode", choices=['serial', 'asyncio'], default='serial', help="How to handle client connections")
+    parser.add_argument("-memory", type=int, default=MEMORY_CACHE_SIZE, help="Megabytes of files to keep in memory (0 to turn this off)")
+    parser.add_argument("-size", type=int, default=CACHE_SIZE, help="Megabytes of files to keep in the cache on disk")
+    parser.add_argument("-entries", type=int, default=MAX_CACHE_ENTRIES, help="Number of files to keep in the cache on disk")
+    parser.add_argument("-tee", action='store_true', help="Send files on to the client as they arrive from the server")
+    parser.add_argument("-max-age", type=int, default=DEFAULT_MAX_AGE, help="Seconds a file stays fresh if the server doesn't say")
+    parser.add_argument("-stale-while-revalidate", type=int, default=DEFAULT_STALE_WHILE_REVALIDATE, help="Seconds a stale file is still sent while it is checked in the background")
+    parser.add_argument("-stale-if-error", type=int, default=DEFAULT_STALE_IF_ERROR, help="Seconds a stale file is still sent if the server can't be reached")
+    parser.add_argument("-policy", choices=['lru', 'lfu', 'gdsf'], default=EVICTION_POLICY, help="How to pick which file to drop when the cache is full")
+    parser.add_argument("-chunks", type=int, default=CHUNK_CACHE_SIZE, help="Megabytes of parts of large files to keep")
+    parser.add_argument("-large-object", type=int, default=LARGE_OBJECT_SIZE, help="Megabytes a file must be for parts of it to be kept")
+    args = parser.parse_args()
+    memory_cache.capacity = args.memory * 1024 * 1024
+    disk_cache.max_size = args.size * 1024 * 1024
+    disk_cache.max_entries = args.entries
+    disk_cache.policy = args.policy
+    TEE_MODE = args.tee
+    DEFAULT_MAX_AGE = args.max_age
+    DEFAULT_STALE_WHILE_REVALIDATE = args.stale_while_revalidate
+    DEFAULT_STALE_IF_ERROR = args.stale_if_error
+    chunk_cache.capacity = args.chunks * 1024 * 1024
+    LARGE_OBJECT_SIZE = args.large_object
+    disk_cache.load()
+    chunk_cache.clear()
 
-                current_time = datetime.datetime.now()
-                m_time = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
-                time_difference=current_time-m_time
-                print('file exists')
-                
-                # check if the file is expired or not, if not, call a conditional GET
+     # Register our signal handler for shutting down.
+    
+    signal.signal(signal.SIGINT, signal_handler)
 
-                if time_difference.total_seconds()<EXPIRE_TIME:
-                    
-                    mtime_string = 'Date: ' + m_time.strftime('%a, %d %b %Y %H:%M:%S EDT')
-                    message = prepare_get_message(host, port, req_file, mtime_string)
-                    client_socket.send(message.encode())
-                    response_line = get_line_from_socket(client_socket)
-                    response_list = response_line.split(' ')
+    # Create the socket.  We will ask this to work on any interface and to pick
+    # a free port at random.  We'll print this out for clients to use.
 
-                    # file in server is older, file in cache is newer and sent to client
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('', 0))
+    print('Will wait for client connections at port ' + str(server_socket.getsockname()[1]))
+    server_socket.listen(LISTEN_BACKLOG)
 
-                    if response_list[1] == '304':
-                        list_of_message = process_file_recieved(response_list[1], response_line, client_socket, headers_done)
-                        print(list_of_message[1])
-                        http_header = print_file_from_socket(client_socket, list_of_message[0])
-                        print("ERROR MESSAGE!!!!!!!!!")
-                        send_response_to_client(conn, '200', file_path)
+    # Keep the server running forever
 
-                    # file in server is newer, remove local file and retrieve a new copy from server
+    if (args.mode == 'asyncio'):
+        asyncio.run(run_asyncio(server_socket))
+    else:
+        while(1):
+            print('Waiting for incoming client connection ...')
+            conn, addr = server_socket.accept()
+            serve_client(conn, addr, False)
 
-                    else:
-                        os.remove(file_path)
-                        print("newer file founded...")
-                        
-                        
-                        print("new file downloading...")
-                        
-                        print("+++")
-                        
-                        headers_done = False
-
-                        list_of_message = process_file_recieved(response_list[1], response_line, client_socket, headers_done)
-
-                        # if file in server is deleted
-
-                        if response_list[1]!='200':
-
-                            http_header = print_file_from_socket(client_socket, list_of_message[0])
-                            print("ERROR MESSAGE!!!!!!!!!")
-                            conn.send(list_of_message[1].encode())
-                            conn.send(http_header.encode())
-                        
-                        # file retrieved successfully, save locally and send back to client
-
-                        else:
-                            print('Success:  Server is sending file.  Downloading it now.')
-                            save_file_from_socket(client_socket, list_of_message[0], file_path)
-                            send_response_to_client(conn, '200', file_path)
-
-
-                        
-                    
-                    
-
-                # file expired, remove stored file and retrieve new one from server
-
-                else:
-                    os.remove(file_path)
-                    print("expired file deleted...")
-                    message = prepare_get_message(host, port, req_file)
-
-                    
-                    client_socket.send(message.encode())
-                    print("new file downloading...")
-                    response_line = get_line_from_socket(client_socket)
-                    print("+++")
-                    response_list = response_line.split(' ')
-                    headers_done = False
-                    
-                    list_of_message = process_file_recieved(response_list[1], response_line, client_socket, headers_done)
-
-                    # file in server is deleted
-
-                    if response_list[1]!='200':
-
-                        http_header = print_file_from_socket(client_socket, list_of_message[0])
-                        print("ERROR MESSAGE!!!!!!!!!")
-                        conn.send(list_of_message[1].encode())
-                        conn.send(http_header.encode())
-                    
-                    # file retrieved successfully
-
-                    else:
-                        save_file_from_socket(client_socket, list_of_message[0], file_path)
-                        send_response_to_client(conn, '200', file_path)
-
-                    
-
-                    
-            
-                   
-                    
         
 if __name__ == '__main__':
     main()
-        
-
-
-
@@ -1,11 +1,82 @@
 import socket
 import sys
-import datetime
+import os
 import signal
-from random import randint
+import select
+import argparse
+import asyncio
+import threading
+import time
+import math
+import hashlib
+from random import random, uniform, sample
+from bisect import bisect
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor, wait
 
 BUFFER_SIZE = 1024
-TIME_OUT = 300
+READ_BUFFER_SIZE = 65536
+LISTEN_BACKLOG = 128
+IDLE_TIMEOUT = 15
+
+# Constants for checking on the servers in the background: how often to check
+# (give or take a random fraction, so the checks don't fall into step with
+# anything else), how long to wait on a server to connect or send us anything,
+# how long a whole round of checks may take, how many servers to check at once,
+# and how many checks in a row a server must fail to be taken out of rotation
+# or pass to be put back.
+
+HEALTH_INTERVAL = 10
+HEALTH_JITTER = 0.2
+HEALTH_TIMEOUT = 5
+PROBE_DEADLINE = 10
+PROBE_WORKERS = 32
+
+# Constants for the configuration: the file listing the servers, and how often
+# to look for changes to it.
+
+CONFIG_FILE = 'configuration.txt'
+CONFIG_POLL_INTERVAL = 2
+FAIL_THRESHOLD = 3
+RISE_THRESHOLD = 2
+
+# The path on each server that reports how it is doing.  Response times below
+# MIN_RESPONSE_TIME are taken to be that, so one very quick check can't give a
+# server all the traffic.
+
+HEALTH_PATH = '/__health'
+MIN_RESPONSE_TIME = 0.001
+
+# Constants for routing: how to pick a server for each request by default, and
+# over how many seconds the moving average of each server's latency forgets
+# what it has seen.
+
+ROUTING_POLICY = 'weighted'
+EWMA_DECAY_TIME = 10
+
+# Constants for consistent hashing: how many points on the ring each server
+# gets, and how far over the average number of requests on the go a server may
+# get before requests for its files overflow to the next server round the ring.
+
+VIRTUAL_NODES = 100
+LOAD_FACTOR = 1.25
+
+# Constants for sending files: whether the kernel can copy files straight to a
+# socket for us, and how much to read at a time when it can't.
+
+USE_SENDFILE = hasattr(os, 'sendfile')
+SEND_BUFFER_SIZE = 262144
+
+# Constants for forwarding requests to the servers in proxy mode: whether the
+# kernel can move a response body from one socket to another for us, how long
+# to wait on a server to send us anything before giving up on it, and how
+# many idle connections to each server we hold on to for reuse and for how
+# long.
+
+USE_SPLICE = hasattr(os, 'splice')
+SERVER_TIMEOUT = 30
+MAX_IDLE_CONNECTIONS = 8
+POOL_IDLE_TIMEOUT = 10
 
 # Signal handler for graceful exiting.
 
@@ -21,306 +92,1160 @@ def prepare_get_message(host, port, file_name):
 
 # Create an HTTP response
 
-def prepare_response_message():
-    message = 'HTTP/1.1 ' + str(301) + ' Moved Permanently'+'\r\n'
+def prepare_response_message(value='301'):
+    if value == '502':
+        message = 'HTTP/1.1 ' + value + ' Bad Gateway' + '\r\n'
+    else:
+        message = 'HTTP/1.1 ' + str(301) + ' Moved Permanently'+'\r\n'
 
     return message
 
+# Construct the header telling the client whether we will keep the connection
+# open after this response.
+
+def prepare_connection_header(keep_alive):
+    if keep_alive:
+        return 'Connection: keep-alive\r\n'
+    else:
+        return 'Connection: close\r\n'
+
+# Construct the 502 we send back when the server we picked can't be reached.
+
+def prepare_bad_gateway_response(keep_alive):
+    with open('502.html', 'rb') as file_to_send:
+        body = file_to_send.read()
+    header = prepare_response_message('502') + 'Content-Type: text/html\r\nContent-Length: ' + str(len(body)) + '\r\n' + prepare_connection_header(keep_alive) + '\r\n'
+    return header.encode() + body
+
+# Send the contents of an open file down a socket.  Where we can, we let the
+# kernel copy the file straight to the socket with sendfile.  Otherwise we fall
+# back to reading the file into one large buffer at a time and sending that.
+
+def send_file_to_socket(sock, file_to_send):
+
+    if USE_SENDFILE:
+        sock.sendfile(file_to_send)
+        return
+
+    buffer = bytearray(SEND_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        count = file_to_send.readinto(buffer)
+        if count:
+            sock.sendall(view[:count])
+        else:
+            break
+
+# Construct the header for a redirect, telling the client whether we will keep
+# the connection open afterwards.
+
+def prepare_response_header(server_info, file_name, keep_alive):
+
+    if keep_alive:
+        connection = 'keep-alive'
+    else:
+        connection = 'close'
+
+    return prepare_response_message() + 'Location: http://' + server_info + '/'+ file_name +'\r\nContent-Length: ' + str(os.path.getsize('301.html')) + '\r\nConnection: ' + connection + '\r\n\r\n'
+
 # Send the given response and file back to the client.
 
-def send_response_to_client(sock, server_info, file_name):
+def send_response_to_client(sock, server_info, file_name, keep_alive):
 
     # Construct header and send it
 
-    header = prepare_response_message() + 'Location: http://' + server_info + '/'+ file_name +'\r\n\r\n'
-    sock.send(header.encode())
+    header = prepare_response_header(server_info, file_name, keep_alive)
+    sock.sendall(header.encode())
 
-    # Open the file, read it, and send it
+    # Open the file and send it
     with open('301.html', 'rb') as file_to_send:
-        while True:
-            chunk = file_to_send.read(BUFFER_SIZE)
-            if chunk:
-                sock.send(chunk)
-            else:
-                break
+        send_file_to_socket(sock, file_to_send)
 
-# Read a single line (ending with \n) from a socket and return it.
-# We will strip out the \r and the \n in the process.
+# Send the given response and file back to the client over a stream.
 
-def get_line_from_socket(sock):
+async def send_response_to_stream(writer, server_info, file_name, keep_alive):
 
-    done = False
-    line = ''
-    while (not done):
-        char = sock.recv(1).decode()
-        if (char == '\r'):
-            pass
-        elif (char == '\n'):
-            done = True
-        else:
-            line = line + char
-    return line
+    # Construct header and send it
+
+    header = prepare_response_header(server_info, file_name, keep_alive)
+    writer.write(header.encode())
+
+    # Open the file and send it
+    with open('301.html', 'rb') as file_to_send:
+        await asyncio.get_running_loop().sendfile(writer.transport, file_to_send)
+
+# A buffered reader wrapped around a connected socket.  Rather than pulling a
+# single byte at a time off the socket, we read whatever is available into a
+# reusable buffer and split lines out of that.  Anything left over once the
+# headers are done is handed back first when the body is read.
+
+class SocketReader:
+
+    def __init__(self, sock, data=b''):
+        self.sock = sock
+        self.buffer = bytearray(data)
+        self.chunk = bytearray(READ_BUFFER_SIZE)
+        self.view = memoryview(self.chunk)
+
+    # Read more data from the socket into our buffer.  Returns the number of
+    # bytes read, which will be 0 once the other side closes the connection.
+
+    def fill(self):
+        count = self.sock.recv_into(self.chunk)
+        self.buffer += self.view[:count]
+        return count
+
+    # Read a single line (ending with \r\n) and return it.  We will strip out
+    # the \r and the \n in the process.  Bytes that aren't valid UTF-8 are
+    # replaced rather than failing, so a garbled request is just one we can't
+    # find the file for, not one that takes us down.
+
+    def get_line(self):
+        start = 0
+        while True:
+            index = self.buffer.find(b'\r\n', start)
+            if (index >= 0):
+                line = self.buffer[:index].decode(errors='replace')
+                del self.buffer[:index + 2]
+                return line
+            start = max(len(self.buffer) - 1, 0)
+            if (self.fill() == 0):
+                line = self.buffer.decode(errors='replace')
+                self.buffer.clear()
+                return line
+
+    # Read up to size bytes of a message body, returning anything still in our
+    # buffer before going back to the socket.
+
+    def recv(self, size):
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        return self.sock.recv(size)
 
 # Read a file from the socket and print it out.  (For 301 html)
 
-def print_file_from_socket(sock, bytes_to_read):
+def print_file_from_socket(reader, bytes_to_read):
 
     bytes_read = 0
     while (bytes_read < bytes_to_read):
-        chunk = sock.recv(BUFFER_SIZE)
+        chunk = reader.recv(BUFFER_SIZE)
+        if (not chunk):
+            break
         bytes_read += len(chunk)
         print(chunk.decode())
 
-# Read a file from the socket and save it out.
+# Read a short body, such as a health report, from the socket into memory.
 
-def save_file_from_socket(sock, bytes_to_read, file_name):
+def read_body_from_socket(reader, bytes_to_read):
 
-    with open(file_name, 'wb') as file_to_write:
-        bytes_read = 0
-        while (bytes_read < bytes_to_read):
-            chunk = sock.recv(BUFFER_SIZE)
-            bytes_read += len(chunk)
-            file_to_write.write(chunk)
+    body = b''
+    while (len(body) < bytes_to_read):
+        chunk = reader.recv(bytes_to_read - len(body))
+        if (not chunk):
+            raise ConnectionError('server closed the connection')
+        body += chunk
+    return body
 
-# function used to test if a given server is available
-# return the response time if yes, return false otherwise
+# Read a file from the socket and throw it away as it comes in, so we can time
+# how fast a server sends it without writing it anywhere.
 
-def test_server(host, port):
+def discard_from_socket(reader, bytes_to_read):
 
-    try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((host,port))
-    except ConnectionRefusedError:
-        print('Error:  That host or port of server is not accepting connections.')
-        return False    
+    while (bytes_to_read > 0):
+        if reader.buffer:
+            count = len(reader.recv(bytes_to_read))
+        else:
+            count = reader.sock.recv_into(reader.view[:min(READ_BUFFER_SIZE, bytes_to_read)])
+        if (count == 0):
+            raise ConnectionError('server closed the connection')
+        bytes_to_read -= count
 
-    # connect success, keep record of time
-    # testing transfer with test.jpg
+# Ask a server for a file over an open connection and read the head of the
+# response.  We return the status code and the length of the body that follows.
+# An error response is printed out in full, body and all.
 
-    print('Connection to server established. Sending message...\n')
-    message = prepare_get_message(host, port, 'test.jpg')
-    start_time = datetime.datetime.now()
-    client_socket.send(message.encode())
+def request_from_server(client_socket, reader, host, port, file_name):
 
-    response_line = get_line_from_socket(client_socket)
-    response_list = response_line.split(' ')
-    headers_done = False
+    message = prepare_get_message(host, port, file_name)
+    client_socket.sendall(message.encode())
 
-    if response_list[1] != '200':
+    response_line = reader.get_line()
+    response_list = response_line.split(' ')
+    code = response_list[1] if (len(response_list) > 1) else ''
+    if (code != '200'):
         print('Error:  An error response was received from the server.  Details:\n')
         print(response_line)
-        bytes_to_read = 0
-        while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
+
+    headers_done = False
+    bytes_to_read = 0
+    while (not headers_done):
+        header_line = reader.get_line()
+        if (code != '200'):
             print(header_line)
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                headers_done = True
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
-        print_file_from_socket(client_socket, bytes_to_read)
+        header_list = header_line.split(' ')
+        if (header_line == ''):
+            headers_done = True
+        elif (header_list[0] == 'Content-Length:'):
+            bytes_to_read = int(header_list[1])
+
+    if (code != '200'):
+        print_file_from_socket(reader, bytes_to_read)
+    return [code, bytes_to_read]
+
+# Turn the report from a server's health path into a dictionary of its
+# numbers, keyed by name.
+
+def parse_health_report(body):
+
+    report = {}
+    for line in body.decode().split('\r\n'):
+        name, _, value = line.partition(':')
+        if value:
+            report[name.strip()] = value.strip()
+    return report
+
+# function used to test if a given server is available
+# return the response time if yes, return false otherwise
+# We ask the server for its health report, which is small and cheap for it to
+# make up.  The response time is how long that took, plus how long the server
+# says it has recently been taking to serve requests (the median of them).  If
+# we are given a probe file, we instead time downloading that over the same
+# connection, throwing it away as it arrives rather than saving it.
+
+def test_server(host, port, probe_file=None):
+
+    try:
+        client_socket = socket.create_connection((host, port), HEALTH_TIMEOUT)
+        reader = SocketReader(client_socket)
+    except OSError:
+        print('Error:  That host or port of server is not accepting connections.')
         return False
-    
-    # test file being transfered successfully
-    else:
 
-        print('Success:  Server is sending test file.  Downloading it now.')
-        
-        # Go through headers and find the size of the file, then save it.
-   
-        bytes_to_read = 0
-        while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                headers_done = True
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
-        save_file_from_socket(client_socket, bytes_to_read, 'test.jpg')
-
-    # subtract starting time from ending time to get response time
-    #     
-    end_time = datetime.datetime.now()
-    response_time = end_time-start_time
-    response_time = response_time.total_seconds()
-    print(response_time)
+    # connect success, keep record of time
+
+    try:
+        start_time = time.perf_counter()
+        code, bytes_to_read = request_from_server(client_socket, reader, host, port, HEALTH_PATH)
+        if (code != '200'):
+            return False
+        report = parse_health_report(read_body_from_socket(reader, bytes_to_read))
+        response_time = time.perf_counter() - start_time + float(report.get('latency_p50', 0))
+
+        if probe_file:
+            start_time = time.perf_counter()
+            code, bytes_to_read = request_from_server(client_socket, reader, host, port, probe_file)
+            if (code != '200'):
+                return False
+            discard_from_socket(reader, bytes_to_read)
+            response_time = time.perf_counter() - start_time
+
+    # the server went quiet on us, dropped the connection part way through, or
+    # sent back something we could not make sense of
+
+    except (OSError, ValueError) as error:
+        print('Error:  Testing server ' + host + ':' + str(port) + ' failed:', error)
+        return False
+    finally:
+        client_socket.close()
+
     return response_time
 
-# return the sum of 1+2+..+n
-
-def sum_from_1_to_n(n):
-    return sum(range(n+1))
-
-# map the servers with different ratios based on their performance
-
-def map_server_performance_ratio(total, num_server, sorted_list):
-    random_range={}
-    counter = total
-    l_num = []
-    difference = total - num_server
-    num = num_server
-    index = 0
-
-    # iterate the loop from the sum of 1 to the number of total servers to 1
-    # for example, if there are 3 servers avaible, total will be 6, and the loop will iterate 6 times
-    # and each server will be matched with different amount of numbers from 1 to 6 based on their performance
-
-    while counter>0:
-        if counter>difference:
-            l_num.append(counter)
-            counter-=1
-        elif counter == difference:
-            list_copy=l_num.copy()
-            random_range[sorted_list[index]] = list_copy
-            index+=1
-            l_num.clear()
-            num-=1
-            difference = difference-num
-             
-            if counter ==1:
-                random_range[sorted_list[-1]] = [1]
-                break
-            l_num.append(counter)
-            counter-=1
-  
-    return random_range
+# Hash a string to a point on the consistent hashing ring.
 
-# Our main function
+def hash_point(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
 
-def main():
+# Build the consistent hashing ring for the given servers.  Each server is put
+# at VIRTUAL_NODES points around the ring, times its weight from the
+# configuration, so the files are shared out evenly, and a file belongs to the
+# first server at or after the point it hashes to.  We return the points in
+# order along with the server at each.  The points don't depend on how fast the
+# servers are; if they moved whenever response times did, files would keep
+# changing servers.
 
-    # keep running the web balancer as a server forever
+def build_hash_ring(server_weights):
 
-    while True:
+    ring = sorted((hash_point(server + '#' + str(index)), server) for server in server_weights for index in range(max(1, round(VIRTUAL_NODES * server_weights[server]))))
+    return [[point for point, server in ring], [server for point, server in ring]]
 
-        # read from the configuration file and store all servers details in list
-        list_servers = []
-
-        with open("configuration.txt", "r") as f:
-            line = f.readline()
-            line = line.strip("\n")
-            list_servers.append(line)
-            while True:
-                line = f.readline()
-                if not line:
-                    break
-                line = line.strip("\n")
-                list_servers.append(line)
-
-        print(list_servers)
-        number_of_server = len(list_servers)
-        list_rtime = {}
-        list_error=[]
-
-        # for each server, do a test and build a dictionary with the server detail and its response time
-
-        for el in list_servers:
-            host = el.split(":")[0]
-            port = int(el.split(":")[1])
-            rtime=test_server(host, port)
-            if not rtime:
-                list_error.append(el)
-                number_of_server-=1
-            else:
-                list_rtime[el]=rtime
-        
-        # keep track of servers which are unavailable
-        # print out the them
+# Work out how the servers should share the traffic from their response
+# times.  Each server is weighted by how many responses it could send in the
+# time it took to answer us, so a server twice as fast gets twice the share,
+# times its weight from the configuration.  We return the servers along with
+# the running totals of their weights, which choose_server searches to pick one.
 
-        if_error = ""
-        for el in list_error:
-            if_error = if_error+el+' '
+def map_server_weights(response_times, server_weights):
 
-        if if_error != "":
-            print("The following servers are unavailable right now...\n"+if_error)
+    servers = list(response_times)
+    weights = [server_weights[server] / max(response_times[server], MIN_RESPONSE_TIME) for server in servers]
+    return [servers, list(accumulate(weights))]
 
-        # sort the dictionary based on the response time, from fastest to slowest
+# Read a request from the client.  We return the request line along with a
+# dictionary of its headers, keyed by their names in lower case.
 
-        list_rtime = {key: value for key, value in sorted(list_rtime.items(), key=lambda item: item[1])}
+def read_request(reader):
 
-        # keep track of sorted server details separately from the time
+    request = reader.get_line()
+    headers = {}
+    header_line = reader.get_line()
+    while (header_line != ''):
+        name, _, value = header_line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+        header_line = reader.get_line()
+    return request, headers
 
-        sorted_list = []
-        for key in list_rtime:
-            sorted_list.append(key)
+# Read a request from a stream in the asyncio mode.  We wait for the whole
+# request to arrive and then parse it the same way as the serial mode does.
 
+async def read_request_async(stream):
 
-        # get range of numbers can be selected from
+    try:
+        head = await stream.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        return '', {}
+    return read_request(SocketReader(None, head))
+
+# pick a random point along the running totals of the weights from
+# map_server_weights and get the server it falls within.  Since the totals are
+# in order, a binary search finds it in O(log n) time however many servers
+# there are.
+
+def choose_server(servers, cumulative_weights):
+
+    point = random() * cumulative_weights[-1]
+    index = bisect(cumulative_weights, point)
+    return servers[min(index, len(servers) - 1)]
+
+# Look at a request and figure out what to do based on the contents of things.
+# We return the server to send the client to and the file it asked for.  If no
+# server is available right now, the server comes back empty.
+
+def process_request(request):
+
+    request_list = request.split()
+
+    # If requested file begins with a / we strip it off.  A request with no
+    # file at all is passed on as it is, for the server to turn down.
+
+    req_file = request_list[1].lstrip('/') if (len(request_list) > 1) else ''
+
+    url = server_table.choose(req_file)
+
+    return url, req_file
+
+# The servers we balance between and how each of them is doing, kept up to date
+# by the health checks running in the background and by the requests we forward
+# to them.  For each server we remember its latest response time, how many
+# checks in a row it has passed or failed, how many requests it has on the go,
+# and a moving average of its latency.  The weights used to pick a server are
+# rebuilt from the servers in rotation after each round of checks, and swapped
+# in all at once under the lock so a request never sees half of an update.
+#
+# How a server is picked for each request depends on the routing policy:
+#
+#   weighted - at random, in proportion to the weights
+#   least-connections - the server with the fewest requests on the go
+#   peak-ewma - the server with the lowest moving average latency, scaled up
+#               by how many requests it has on the go
+#   p2c - two servers at random, then the better of them by peak-ewma
+#   round-robin - each in turn, with faster servers given more turns in
+#                 proportion to the weights
+#   consistent-hash - the server the file asked for belongs to on the hash
+#                     ring, so each file keeps going to the same server and
+#                     each server only has to hold its share of the files in
+#                     memory.  If that server has more than LOAD_FACTOR times
+#                     the average requests on the go, the next server round
+#                     the ring that doesn't takes the request instead.
+#
+# All but weighted look at the requests on the go, which we only know about
+# when forwarding requests ourselves.  Redirected clients go to the servers
+# directly, so with -routing redirect those policies go by latency alone.
+#
+# The servers in the table are the ones in the configuration, along with the
+# weight each was given there.  When the configuration changes, servers are
+# added and removed in place.
+
+class ServerTable:
+
+    def __init__(self, policy=ROUTING_POLICY):
+        self.lock = threading.Lock()
+        self.policy = policy
+        self.configured = {}
+        self.servers = {}
+        self.weights = [[], []]
+        self.round_robin = {}
+        self.ring = [[], []]
+
+    # Record the result of checking a server: its response time, or False if
+    # the check failed.  The first result for a server decides straight away
+    # whether it is in rotation; after that it takes FAIL_THRESHOLD failures in
+    # a row to take it out and RISE_THRESHOLD passes in a row to put it back.
+
+    def record(self, server, rtime):
+        with self.lock:
+            if server not in self.configured:
+                return
+            state = self.servers.get(server)
+            if state is None:
+                state = {'healthy': rtime is not False, 'rtime': rtime, 'weight': self.configured[server], 'passes': 0, 'failures': 0, 'outstanding': 0, 'ewma': None, 'updated': 0}
+                self.servers[server] = state
+                if (rtime is not False):
+                    self.update_ewma(state, rtime)
+                if (not state['healthy']):
+                    print('Server ' + server + ' is unavailable right now.')
+                return
+            if rtime is False:
+                state['passes'] = 0
+                state['failures'] += 1
+                if (state['healthy'] and (state['failures'] >= FAIL_THRESHOLD)):
+                    state['healthy'] = False
+                    print('Server ' + server + ' failed ' + str(state['failures']) + ' checks in a row, taking it out of rotation.')
+            else:
+                state['rtime'] = rtime
+                self.update_ewma(state, rtime)
+                state['failures'] = 0
+                state['passes'] += 1
+                if ((not state['healthy']) and (state['passes'] >= RISE_THRESHOLD)):
+                    state['healthy'] = True
+                    print('Server ' + server + ' is back, putting it into rotation.')
+
+    # Rebuild the weights used to pick a server from the latest response times
+    # of the servers in rotation.  We return the servers, fastest first.
+
+    def rebuild(self):
+        with self.lock:
+            return self.build()
+
+    def build(self):
+        healthy = {server: state['rtime'] for server, state in self.servers.items() if state['healthy']}
+        server_weights = {server: self.servers[server]['weight'] for server in healthy}
+        self.weights = map_server_weights(healthy, server_weights)
+        self.round_robin = {}
+        self.ring = build_hash_ring(server_weights)
+        return sorted(healthy, key=lambda server: healthy[server])
+
+    # Bring the table in line with a new configuration: a dictionary of the
+    # servers in it and their weights.  Servers no longer in it are dropped
+    # straight away, and any requests still on the go to them are left to
+    # finish.  Servers still in it take on their new weights.  We return the
+    # servers that are new, which only go into rotation once they have been
+    # checked.
+
+    def configure(self, server_weights):
+        with self.lock:
+            for server in list(self.servers):
+                if server not in server_weights:
+                    del self.servers[server]
+                    print('Server ' + server + ' is no longer in the configuration, taking it out of rotation.')
+                else:
+                    self.servers[server]['weight'] = server_weights[server]
+            added = [server for server in server_weights if server not in self.configured]
+            self.configured = dict(server_weights)
+            self.build()
+        return added
+
+    # The servers in the configuration, for the health checks to go through.
+
+    def names(self):
+        with self.lock:
+            return list(self.configured)
+
+    # Fold a new latency into a server's moving average.  The older the average
+    # is, the less it counts for.  A latency above the average replaces it
+    # outright, so a server that slows down is avoided straight away and only
+    # trusted again once it has been quick for a while.
+
+    def update_ewma(self, state, latency):
+        now = time.monotonic()
+        if ((state['ewma'] is None) or (latency > state['ewma'])):
+            state['ewma'] = latency
+        else:
+            decay = math.exp(-(now - state['updated']) / EWMA_DECAY_TIME)
+            state['ewma'] = state['ewma'] * decay + latency * (1 - decay)
+        state['updated'] = now
 
-        total_random_num = sum_from_1_to_n(number_of_server)
+    # The cost of sending a server one more request by peak-ewma: its moving
+    # average latency, scaled up by the requests it already has on the go and
+    # down by its weight.
 
-        # map each server to a specific range of number
-        # details explained in comments of map_server_performance_ratio function
+    def cost(self, server):
+        state = self.servers[server]
+        return (state['ewma'] or 0) * (state['outstanding'] + 1) / state['weight']
 
-        performance_ratio = map_server_performance_ratio(total_random_num, number_of_server, sorted_list)
+    # Pick a server for a request for the given file, or return an empty string
+    # if none are in rotation.
 
+    def choose(self, file_name=''):
+        with self.lock:
+            servers, cumulative_weights = self.weights
+            if ((not servers) or (self.policy == 'weighted')):
+                pass
+            elif (self.policy == 'least-connections'):
+                return min(servers, key=lambda server: (self.servers[server]['outstanding'] / self.servers[server]['weight'], random()))
+            elif (self.policy == 'peak-ewma'):
+                return min(servers, key=self.cost)
+            elif (self.policy == 'p2c'):
+                if (len(servers) == 1):
+                    return servers[0]
+                first, second = sample(servers, 2)
+                return first if (self.cost(first) <= self.cost(second)) else second
+            elif (self.policy == 'consistent-hash'):
+                return self.next_on_ring(file_name)
+            else:
+                return self.next_round_robin(servers, cumulative_weights)
+        if (not servers):
+            return ''
+        return choose_server(servers, cumulative_weights)
+
+    # Pick the next server in turn for round-robin, spreading each server's
+    # turns evenly through the rounds rather than bunching them together.  Each
+    # server builds up credit by its weight every pick; the one with the most
+    # credit goes next and pays back the total of all the weights.
+
+    def next_round_robin(self, servers, cumulative_weights):
+        best = None
+        for index in range(len(servers)):
+            weight = cumulative_weights[index] - (cumulative_weights[index - 1] if index else 0)
+            credit = self.round_robin.get(servers[index], 0) + weight
+            self.round_robin[servers[index]] = credit
+            if ((best is None) or (credit > self.round_robin[best])):
+                best = servers[index]
+        self.round_robin[best] -= cumulative_weights[-1]
+        return best
+
+    # Find the server a file belongs to on the hash ring, walking on round the
+    # ring past any server that already has more than its share of requests
+    # on the go.  If every server does, the file goes to its own server anyway.
+
+    def next_on_ring(self, file_name):
+        points, owners = self.ring
+        outstanding = sum(self.servers[server]['outstanding'] for server in self.weights[0])
+        capacity = math.ceil(LOAD_FACTOR * (outstanding + 1) / len(self.weights[0]))
+        start = bisect(points, hash_point(file_name))
+        seen = set()
+        for index in range(start, start + len(points)):
+            server = owners[index % len(points)]
+            if (server in seen):
+                continue
+            if (self.servers[server]['outstanding'] < capacity):
+                return server
+            seen.add(server)
+            if (len(seen) == len(self.weights[0])):
+                break
+        return owners[start % len(points)]
+
+    # Note that a request has been sent on to a server, and that one has
+    # finished, along with how long the server took to start answering it.  A
+    # request that failed has no latency to go by.  The server may have been
+    # taken out of the configuration in the meantime, in which case there is
+    # nothing left to update.
+
+    def request_started(self, server):
+        with self.lock:
+            if server in self.servers:
+                self.servers[server]['outstanding'] += 1
+
+    def request_finished(self, server, latency):
+        with self.lock:
+            state = self.servers.get(server)
+            if state is None:
+                return
+            state['outstanding'] = max(state['outstanding'] - 1, 0)
+            if (latency is not None):
+                self.update_ewma(state, latency)
+
+server_table = ServerTable()
+
+# Check each of the servers once and update the table with the results.  The
+# servers are all checked at the same time by a pool of threads, so a round
+# takes about as long as the slowest server rather than all of them added up.
+# Any server that hasn't answered within deadline seconds counts as failed;
+# its check carries on in the background, but we go ahead without it.
+
+probe_pool = ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+
+def check_servers(list_servers, probe_file=None, deadline=PROBE_DEADLINE):
+
+    probes = {}
+    for el in list_servers:
+        host = el.split(":")[0]
+        port = int(el.split(":")[1])
+        probes[probe_pool.submit(test_server, host, port, probe_file)] = el
+    done, not_done = wait(probes, timeout=deadline)
+
+    for probe in probes:
+        if probe in done:
+            server_table.record(probes[probe], probe.result())
+        else:
+            print('Error:  Testing server ' + probes[probe] + ' took longer than ' + str(deadline) + ' seconds.')
+            server_table.record(probes[probe], False)
+    return server_table.rebuild()
 
+# Keep checking the servers in the background for as long as the balancer runs,
+# waiting about interval seconds between rounds.
 
-        # Register our signal handler for shutting down.
+def run_health_checks(interval, probe_file=None, deadline=PROBE_DEADLINE):
 
-        signal.signal(signal.SIGINT, signal_handler)
+    while True:
+        time.sleep(interval * uniform(1 - HEALTH_JITTER, 1 + HEALTH_JITTER))
+        check_servers(server_table.names(), probe_file, deadline)
+
+# Read the configuration file.  Each line names a server as host:port, which
+# may be followed by a weight (1 if not given) to send it more or less of the
+# traffic than its speed alone would.  A line reading listen followed by a
+# port number fixes the port we wait for clients on; otherwise one is picked
+# at random.  Blank lines and anything after a # are ignored, as are lines we
+# can't make sense of, which we point out.  We return a dictionary of the
+# servers and their weights, in the order they were listed, and the port to
+# listen on, or 0 for any.
+
+def read_configuration(file_name):
+
+    server_weights = {}
+    listen_port = 0
+    with open(file_name, "r") as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            try:
+                if (not fields):
+                    continue
+                elif ((fields[0] == 'listen') and (len(fields) == 2)):
+                    listen_port = int(fields[1])
+                elif ((len(fields) <= 2) and (':' in fields[0])):
+                    int(fields[0].split(':')[1])
+                    weight = float(fields[1]) if (len(fields) == 2) else 1.0
+                    if (weight <= 0):
+                        raise ValueError('weight must be more than 0')
+                    server_weights[fields[0]] = weight
+                else:
+                    raise ValueError('expected host:port [weight] or listen port')
+            except ValueError as error:
+                print('Error:  Ignoring line in ' + file_name + ':', line.strip(), '(' + str(error) + ')')
+    return [server_weights, listen_port]
+
+# Set when we are sent a SIGHUP, to have the configuration read again straight
+# away.
+
+config_changed = threading.Event()
+
+def hangup_handler(sig, frame):
+    config_changed.set()
+
+# Read the configuration again and apply it to the server table in place,
+# without touching the socket clients connect to or any connections already
+# open.  New servers are checked before going into rotation.
+
+def reload_configuration(file_name, listen_port, probe_file=None, deadline=PROBE_DEADLINE):
 
-        # Create the socket.  We will ask this to work on any interface and to pick
-        # a free port at random.  We'll print this out for clients to use.
+    try:
+        server_weights, new_listen_port = read_configuration(file_name)
+    except OSError as error:
+        print('Error:  Could not read ' + file_name + ', keeping the configuration we have:', error)
+        return
+    print('Configuration changed, now balancing between:', list(server_weights))
+    if (new_listen_port != listen_port):
+        print('The listen port can only be changed by restarting the balancer, still waiting at the same port.')
+    added = server_table.configure(server_weights)
+    if added:
+        check_servers(added, probe_file, deadline)
+
+# Watch the configuration file for as long as the balancer runs, reading it
+# again whenever it is modified or we are sent a SIGHUP.
+
+def watch_configuration(file_name, listen_port, probe_file=None, deadline=PROBE_DEADLINE):
+
+    last_modified = os.stat(file_name).st_mtime_ns
+    while True:
+        hangup = config_changed.wait(CONFIG_POLL_INTERVAL)
+        config_changed.clear()
+        try:
+            modified = os.stat(file_name).st_mtime_ns
+        except OSError:
+            continue
+        if ((modified != last_modified) or hangup):
+            last_modified = modified
+            reload_configuration(file_name, listen_port, probe_file, deadline)
+
+# Check whether the client wants the connection kept open after this request.
+# HTTP/1.1 connections stay open unless the client asks for them to be closed.
+
+def keep_connection_alive(request, headers):
+
+    return ((request.endswith('HTTP/1.1')) and (headers.get('connection', '').lower() != 'close'))
+
+# A pool of open connections to servers, kept by host:port, so that requests
+# forwarded to the same server can reuse a connection rather than connecting
+# all over again.
+
+class ConnectionPool:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    # Get a connection to the given server, reusing an idle one if we have one.
+    # We return the socket, a reader for it, and whether it was reused.  New
+    # connections get the same time to connect as the health checks, and then
+    # SERVER_TIMEOUT to answer each request, so a server that hangs can't hold
+    # us up for good.
+
+    def get(self, host, port):
+        key = host + ':' + str(port)
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                client_socket, server_reader, idle_since = connections.pop()
+                if (time.monotonic() - idle_since < POOL_IDLE_TIMEOUT):
+                    return client_socket, server_reader, True
+                client_socket.close()
+        client_socket = socket.create_connection((host, port), HEALTH_TIMEOUT)
+        client_socket.settimeout(SERVER_TIMEOUT)
+        return client_socket, SocketReader(client_socket), False
+
+    # Hand back a connection we are done with so it can be reused.
+
+    def put(self, host, port, client_socket, server_reader):
+        key = host + ':' + str(port)
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if (len(connections) < MAX_IDLE_CONNECTIONS):
+                connections.append((client_socket, server_reader, time.monotonic()))
+                return
+        client_socket.close()
+
+server_pool = ConnectionPool()
+
+# Construct the request to forward to a server: the client's request as it
+# came to us, less its Connection header, since our connections to the servers
+# are kept open for as long as the servers are happy to.
+
+def prepare_forward_message(request, headers):
+    message = request + '\r\n'
+    for name in headers:
+        if (name != 'connection'):
+            message = message + name + ': ' + headers[name] + '\r\n'
+    return message + '\r\n'
+
+# Read the headers of a response from a server.  We return them in a
+# dictionary keyed by their names in lower case, along with the header lines
+# themselves to pass on to the client.  The Connection header is left out of
+# those, since it only applies to our connection with the server.
+
+def read_response_headers(reader):
+    headers = {}
+    lines = ''
+    header_line = reader.get_line()
+    while (header_line != ''):
+        name, _, value = header_line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+        if (name.strip().lower() != 'connection'):
+            lines = lines + header_line + '\r\n'
+        header_line = reader.get_line()
+    return [headers, lines]
+
+# Send a request to a server over a pooled connection and read the status line
+# of its response.  If a connection we reused turns out to have been closed by
+# the server in the meantime, we try again on a new one.  A server that takes
+# too long to answer is not tried again.  We return the socket, its reader and
+# the status line, or None if the server could not be reached.
+
+def send_to_server(host, port, message):
+
+    while True:
+        try:
+            client_socket, server_reader, reused = server_pool.get(host, port)
+        except OSError:
+            print('Error:  That host or port of server is not accepting connections.')
+            return None
+        try:
+            client_socket.sendall(message.encode())
+            response_line = server_reader.get_line()
+        except socket.timeout:
+            print('Error:  The server took too long to answer.')
+            client_socket.close()
+            return None
+        except OSError:
+            response_line = ''
+        if (response_line != ''):
+            return client_socket, server_reader, response_line
+        client_socket.close()
+        if (not reused):
+            print('Error:  The server closed the connection.')
+            return None
+
+# Pass count bytes of a response body from a server on to the client.  Anything
+# already read into the reader's buffer goes first.  Where we can, we have the
+# kernel splice the rest from one socket to the other through a pipe, so the
+# body never has to be copied through Python; otherwise we read it in and send
+# it on one large buffer at a time.  Before each splice we wait for the socket
+# to be ready, for no longer than its timeout, just as a recv or send on it
+# would.
+
+def relay_body(server_reader, sock, count):
+
+    if server_reader.buffer:
+        data = server_reader.recv(count)
+        sock.sendall(data)
+        count -= len(data)
+
+    if (USE_SPLICE and (count > 0)):
+        read_end, write_end = os.pipe()
+        try:
+            while (count > 0):
+                wait_for_socket(server_reader.sock, select.POLLIN)
+                try:
+                    moved = os.splice(server_reader.sock.fileno(), write_end, min(SEND_BUFFER_SIZE, count))
+                except BlockingIOError:
+                    continue
+                if (moved == 0):
+                    raise ConnectionError('server closed the connection')
+                count -= moved
+                while (moved > 0):
+                    wait_for_socket(sock, select.POLLOUT)
+                    try:
+                        moved -= os.splice(read_end, sock.fileno(), moved)
+                    except BlockingIOError:
+                        pass
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+        return
+
+    while (count > 0):
+        chunk = server_reader.recv(min(SEND_BUFFER_SIZE, count))
+        if (not chunk):
+            raise ConnectionError('server closed the connection')
+        sock.sendall(chunk)
+        count -= len(chunk)
+
+# Wait for a socket to be ready to read from or write to, raising
+# socket.timeout if it isn't within the socket's timeout.  A socket with no
+# timeout is left to block in the splice itself.
+
+def wait_for_socket(sock, event):
+
+    timeout = sock.gettimeout()
+    if (timeout is None):
+        return
+    poller = select.poll()
+    poller.register(sock, event)
+    if (not poller.poll(timeout * 1000)):
+        raise socket.timeout('timed out')
+
+# Forward a request to the given server and pass its response back to the
+# client, in proxy mode.  If the server can't be reached, the client gets a
+# 502 instead.  Once the response has gone through, we keep the connection to
+# the server for the next request if the server is happy to.  The server table
+# is kept posted on the request, and on how long the server took to start
+# answering it, for the routing policies to go by.
+
+def forward_request(sock, request, headers, server_info, keep_alive):
+
+    server_table.request_started(server_info)
+    latency = None
+    try:
+        start_time = time.perf_counter()
+        sent = relay_response(sock, request, headers, server_info, keep_alive)
+        if sent:
+            latency = sent - start_time
+    finally:
+        server_table.request_finished(server_info, latency)
+
+# Do the work of forward_request, returning the time the response from the
+# server started coming in, or None if the server could not be reached.
+
+def relay_response(sock, request, headers, server_info, keep_alive):
+
+    host = server_info.split(':')[0]
+    port = int(server_info.split(':')[1])
+    sent = send_to_server(host, port, prepare_forward_message(request, headers))
+    if sent is None:
+        sock.sendall(prepare_bad_gateway_response(keep_alive))
+        return None
+    client_socket, server_reader, response_line = sent
+    first_byte_time = time.perf_counter()
 
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind(('', 0))
-        print('Will wait for client connections at port ' + str(server_socket.getsockname()[1]))
-        server_socket.listen(1)
-        server_socket.settimeout(TIME_OUT)
+    try:
+        response_headers, header_lines = read_response_headers(server_reader)
+        sock.sendall((response_line + '\r\n' + header_lines + prepare_connection_header(keep_alive) + '\r\n').encode())
+        relay_body(server_reader, sock, int(response_headers.get('content-length', 0)))
+    except:
+        client_socket.close()
+        raise
+
+    if (response_headers.get('connection', '').lower() != 'close'):
+        server_pool.put(host, port, client_socket, server_reader)
+    else:
+        client_socket.close()
+    return first_byte_time
+
+# A pool of open stream connections to servers for the asyncio mode, kept by
+# host:port.  The pool is only ever used from the event loop, so it needs no
+# lock.
+
+class StreamPool:
+
+    def __init__(self):
+        self.idle = {}
+
+    # Get a connection to the given server, reusing an idle one if we have one.
+    # We return the reader and writer for it, and whether it was reused.  New
+    # connections get the same time to connect as the health checks.
+
+    async def get(self, host, port):
+        connections = self.idle.get((host, port), [])
+        while connections:
+            stream, writer, idle_since = connections.pop()
+            if (time.monotonic() - idle_since < POOL_IDLE_TIMEOUT):
+                return stream, writer, True
+            writer.close()
+        stream, writer = await asyncio.wait_for(asyncio.open_connection(host, port), HEALTH_TIMEOUT)
+        return stream, writer, False
+
+    # Hand back a connection we are done with so it can be reused.
+
+    def put(self, host, port, stream, writer):
+        connections = self.idle.setdefault((host, port), [])
+        if (len(connections) < MAX_IDLE_CONNECTIONS):
+            connections.append((stream, writer, time.monotonic()))
+        else:
+            writer.close()
 
-        # Keep the server running forever.
-        
-        while(1):
-            print('Waiting for incoming client connection ...')
-            
-            # check if the connect is timed out or not
-            # if timed out, the program will run the server tests again
-            # then start a new connection as a server
+stream_pool = StreamPool()
 
+# Forward a request to the given server and pass its response back to the
+# client over a stream, in the asyncio mode.  This works just like
+# forward_request, with the body copied from one stream to the other.
+
+async def forward_request_async(writer, request, headers, server_info, keep_alive):
+
+    server_table.request_started(server_info)
+    latency = None
+    try:
+        start_time = time.perf_counter()
+        sent = await relay_response_async(writer, request, headers, server_info, keep_alive)
+        if sent:
+            latency = sent - start_time
+    finally:
+        server_table.request_finished(server_info, latency)
+
+# Do the work of forward_request_async, returning the time the response from
+# the server started coming in, or None if the server could not be reached.
+# As in proxy mode, we wait no longer than SERVER_TIMEOUT on each read from the
+# server, and a server that takes too long to answer is not tried again.
+
+async def relay_response_async(writer, request, headers, server_info, keep_alive):
+
+    host = server_info.split(':')[0]
+    port = int(server_info.split(':')[1])
+    message = prepare_forward_message(request, headers).encode()
+    while True:
+        try:
+            stream, server_writer, reused = await stream_pool.get(host, port)
+        except OSError:
+            print('Error:  That host or port of server is not accepting connections.')
+            writer.write(prepare_bad_gateway_response(keep_alive))
+            await writer.drain()
+            return None
+        try:
+            server_writer.write(message)
+            await server_writer.drain()
+            head = await asyncio.wait_for(stream.readuntil(b'\r\n\r\n'), SERVER_TIMEOUT)
+            first_byte_time = time.perf_counter()
+            break
+        except TimeoutError:
+            print('Error:  The server took too long to answer.')
+            server_writer.close()
+            writer.write(prepare_bad_gateway_response(keep_alive))
+            await writer.drain()
+            return None
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            server_writer.close()
+            if (not reused):
+                print('Error:  The server closed the connection.')
+                writer.write(prepare_bad_gateway_response(keep_alive))
+                await writer.drain()
+                return None
+
+    try:
+        server_reader = SocketReader(None, head)
+        response_line = server_reader.get_line()
+        response_headers, header_lines = read_response_headers(server_reader)
+        writer.write((response_line + '\r\n' + header_lines + prepare_connection_header(keep_alive) + '\r\n').encode())
+        count = int(response_headers.get('content-length', 0))
+        while (count > 0):
             try:
-                conn, addr = server_socket.accept()
-                print('Accepted connection from client address:', addr)
-                print('Connection to client established, waiting to receive message...')
-            except:
-                break
+                chunk = await asyncio.wait_for(stream.read(min(SEND_BUFFER_SIZE, count)), SERVER_TIMEOUT)
+            except TimeoutError:
+                raise ConnectionError('server took too long to answer')
+            if (not chunk):
+                raise ConnectionError('server closed the connection')
+            writer.write(chunk)
+            await writer.drain()
+            count -= len(chunk)
+        await writer.drain()
+    except:
+        server_writer.close()
+        raise
+
+    if (response_headers.get('connection', '').lower() != 'close'):
+        stream_pool.put(host, port, stream, server_writer)
+    else:
+        server_writer.close()
+    return first_byte_time
+
+# Serve a single client connection in the asyncio mode, for as many requests as
+# the client wants to make on it.  Depending on routing, each request is either
+# forwarded to the server we pick (proxy) or answered with a redirect to it.
 
-            # We obtain our request from the socket.  We look at the request and
-            # figure out what to do based on the contents of things.
-            # pick a random number from the range mentioned above and get its corresponding server
+async def serve_client_async(stream, writer, routing):
 
-            url=''
-            request = get_line_from_socket(conn)
+    print('Accepted connection from client address:', writer.get_extra_info('peername'))
+    try:
+        keep_alive = True
+        while keep_alive:
+            request, headers = await asyncio.wait_for(read_request_async(stream), IDLE_TIMEOUT)
+            if (request == ''):
+                break
             print('Received request:  ' + request)
-            ran_num = randint(1, total_random_num)
-            for key in performance_ratio:
-                if ran_num in performance_ratio[key]:
-                    url = key
-            
-            request_list = request.split()
+            url, req_file = process_request(request)
+            keep_alive = keep_connection_alive(request, headers)
+            if (url == ''):
+                print('No servers are available, sending 502 ...')
+                writer.write(prepare_bad_gateway_response(keep_alive))
+                await writer.drain()
+            elif (routing == 'proxy'):
+                print('Server found, forwarding request to ' + url + ' ...')
+                await forward_request_async(writer, request, headers, url, keep_alive)
+            else:
+                print('Server found, sending redirecting details...')
+                await send_response_to_stream(writer, url, req_file, keep_alive)
+    except TimeoutError:
+        print('Connection to client idle for too long, closing it ...')
+    except OSError as error:
+        print('Error:  Connection to client failed:', error)
 
-            # This server doesn't care about headers, so we just clean them up.
+    # We are all done with this client, so close the connection.
 
-            while (get_line_from_socket(conn) != ''):
-                pass
+    finally:
+        writer.close()
+
+# Serve clients from a single asyncio event loop, forever.
 
-            # If requested file begins with a / we strip it off.
+async def run_asyncio(server_socket, routing):
 
-            req_file = request_list[1]
-            while (req_file[0] == '/'):
-                req_file = req_file[1:]
+    async def serve_client(stream, writer):
+        await serve_client_async(stream, writer, routing)
 
-            
-            print('Server found, sending redirecting details...')
-            send_response_to_client(conn, url, req_file)
-                
-            # We are all done with this client, so close the connection and
-            # Go back to get another one!
+    server = await asyncio.start_server(serve_client, sock=server_socket, backlog=LISTEN_BACKLOG)
+    print('Waiting for incoming client connections ...')
+    async with server:
+        await server.serve_forever()
+
+# Our main function
+
+def main():
+
+    # Check command line arguments for how we should handle connections.
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-mode", choices=['serial', 'asyncio'], default='serial', help="How to handle client connections")
+    parser.add_argument("-routing", choices=['proxy', 'redirect'], default='proxy', help="Forward requests to the servers, or redirect clients to them with a 301")
+    parser.add_argument("-health-interval", type=float, default=HEALTH_INTERVAL, help="Seconds between checks on the servers")
+    parser.add_argument("-policy", choices=['weighted', 'least-connections', 'peak-ewma', 'p2c', 'round-robin', 'consistent-hash'], default=ROUTING_POLICY, help="How to pick a server for each request")
+    parser.add_argument("-probe-deadline", type=float, default=PROBE_DEADLINE, help="Seconds a round of checks on the servers may take")
+    parser.add_argument("-probe-file", help="File to download from each server when checking on it, to measure throughput")
+    args = parser.parse_args()
+    server_table.policy = args.policy
+
+    # read from the configuration file the servers, their weights and the port
+    # to listen on
+
+    server_weights, listen_port = read_configuration(CONFIG_FILE)
+    print(list(server_weights))
+    server_table.configure(server_weights)
+
+    # test each server once before we start, so we know which are available and
+    # how fast each of them is, then keep checking them in the background.
+    # As servers fail or come back, or the configuration changes, the table of
+    # servers changes under us, but we keep serving clients on the same port
+    # the whole time.
+
+    sorted_list = check_servers(list(server_weights), args.probe_file, args.probe_deadline)
+    print('Servers in rotation, fastest first:', sorted_list)
+    health_checker = threading.Thread(target=run_health_checks, args=(args.health_interval, args.probe_file, args.probe_deadline), daemon=True)
+    health_checker.start()
+    config_watcher = threading.Thread(target=watch_configuration, args=(CONFIG_FILE, listen_port, args.probe_file, args.probe_deadline), daemon=True)
+    config_watcher.start()
+
+    # Register our signal handlers for shutting down and for reading the
+    # configuration again.
+
+    signal.signal(signal.SIGINT, signal_handler)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, hangup_handler)
+
+    # Create the socket.  We will ask this to work on any interface and, unless
+    # the configuration gives a port, to pick a free port at random.  We'll print
+    # this out for clients to use.
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if listen_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(('', listen_port))
+    print('Will wait for client connections at port ' + str(server_socket.getsockname()[1]))
+    server_socket.listen(LISTEN_BACKLOG)
+
+    if (args.mode == 'asyncio'):
+        asyncio.run(run_asyncio(server_socket, args.routing))
+        return
+
+    # Keep the server running forever.
+
+    while(1):
+        print('Waiting for incoming client connection ...')
+
+        try:
+            conn, addr = server_socket.accept()
+            conn.settimeout(None)
+            reader = SocketReader(conn)
+            print('Accepted connection from client address:', addr)
+            print('Connection to client established, waiting to receive message...')
+        except OSError as error:
+            print('Error:  Accepting a client connection failed:', error)
+            continue
+
+        # We obtain our request from the socket.  We look at the request and
+        # figure out what to do based on the contents of things.
+
+        try:
+            request, headers = read_request(reader)
+            if (request == ''):
+                conn.close()
+                continue
+            print('Received request:  ' + request)
+            url, req_file = process_request(request)
+
+            if (url == ''):
+                print('No servers are available, sending 502 ...')
+                conn.sendall(prepare_bad_gateway_response(False))
+            elif (args.routing == 'proxy'):
+                print('Server found, forwarding request to ' + url + ' ...')
+                forward_request(conn, request, headers, url, False)
+            else:
+                print('Server found, sending redirecting details...')
+                send_response_to_client(conn, url, req_file, False)
+        except OSError as error:
+            print('Error:  Connection to client or server failed:', error)
 
-            conn.close();
-            
+        # We are all done with this client, so close the connection and
+        # Go back to get another one!  We don't keep connections open here,
+        # since one client would then hold up all the rest.
 
+        conn.close();
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
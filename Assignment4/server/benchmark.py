@@ -0,0 +1,108 @@
+import socket
+import os
+import time
+import argparse
+import tempfile
+import threading
+
+import server
+
+# Constant for the buffer size of the original send loop we compare against
+
+BUFFER_SIZE = 1024
+
+# The original way the server sent files: read 1024 bytes at a time and hand
+# each chunk to send.
+
+def send_file_in_chunks(sock, file_to_send):
+    while True:
+        chunk = file_to_send.read(BUFFER_SIZE)
+        if chunk:
+            sock.sendall(chunk)
+        else:
+            break
+
+# Send the file with the server's send_file_to_socket, either letting it use
+# sendfile or forcing it onto its fallback loop.
+
+def send_file_with_sendfile(sock, file_to_send):
+    server.USE_SENDFILE = True
+    server.send_file_to_socket(sock, file_to_send)
+
+def send_file_with_fallback(sock, file_to_send):
+    server.USE_SENDFILE = False
+    server.send_file_to_socket(sock, file_to_send)
+
+# Read and throw away everything sent to us until the other side closes.
+
+def drain_socket(sock):
+    buffer = bytearray(server.READ_BUFFER_SIZE)
+    while (sock.recv_into(buffer) > 0):
+        pass
+    sock.close()
+
+# Time sending the file over a fresh local TCP connection, returning how many
+# seconds it took for the receiving side to get all of it.
+
+def time_transfer(send_function, file_name):
+
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.bind(('localhost', 0))
+    listen_socket.listen(1)
+    client_socket = socket.create_connection(listen_socket.getsockname())
+    conn, addr = listen_socket.accept()
+    listen_socket.close()
+    receiver = threading.Thread(target=drain_socket, args=(client_socket,))
+    receiver.start()
+
+    start_time = time.perf_counter()
+    with open(file_name, 'rb') as file_to_send:
+        send_function(conn, file_to_send)
+    conn.close()
+    receiver.join()
+    return time.perf_counter() - start_time
+
+# Create a file of the given number of megabytes to send.
+
+def create_test_file(megabytes):
+    test_file = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+    block = os.urandom(1024 * 1024)
+    for i in range(megabytes):
+        test_file.write(block)
+    test_file.close()
+    return test_file.name
+
+# Our main function.
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-file", help="File to send (a random file is created if not given)")
+    parser.add_argument("-size", type=int, default=64, help="Size in megabytes of the random file to create")
+    parser.add_argument("-repeat", type=int, default=5, help="Number of times to send the file with each method")
+    args = parser.parse_args()
+
+    file_name = args.file if args.file else create_test_file(args.size)
+    file_size = os.path.getsize(file_name)
+    print('Sending ' + file_name + ' (' + str(file_size) + ' bytes) ' + str(args.repeat) + ' times with each method ...\n')
+
+    methods = [('1024 byte chunks', send_file_in_chunks), ('fallback loop', send_file_with_fallback)]
+    if hasattr(os, 'sendfile'):
+        methods.append(('sendfile', send_file_with_sendfile))
+    else:
+        print('sendfile is not available on this platform, skipping it.\n')
+
+    # Report the best time for each method, along with the throughput it gives.
+
+    try:
+        for name, send_function in methods:
+            best_time = min(time_transfer(send_function, file_name) for i in range(args.repeat))
+            throughput = file_size / best_time / (1024 * 1024)
+            print(f'{name:>18}:  {best_time:8.4f} s  {throughput:10.1f} MB/s')
+    finally:
+        if (not args.file):
+            os.remove(file_name)
+
+
+if __name__ == '__main__':
+    main()
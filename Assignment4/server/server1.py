@@ -3,10 +3,47 @@ import os
 import datetime
 import signal
 import sys
+import argparse
+import selectors
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import RawArray
 
 # Constant for our buffer size
 
-BUFFER_SIZE = 1024
+READ_BUFFER_SIZE = 65536
+
+# Constants for sending files: whether the kernel can copy files straight to a
+# socket for us, and how much to read at a time when it can't.
+
+USE_SENDFILE = hasattr(os, 'sendfile')
+SEND_BUFFER_SIZE = 262144
+
+# Constants for handling connections: how many worker threads to use in thread
+# mode, how many pending connections the listening socket will queue, and how
+# many seconds we keep an idle keep-alive connection open.
+
+DEFAULT_WORKERS = 16
+LISTEN_BACKLOG = 128
+IDLE_TIMEOUT = 15
+
+# Constants for reporting on how the server is doing: the path a load balancer
+# can ask for to check on us, and how many of the most recent requests we keep
+# the times of.
+
+HEALTH_PATH = '__health'
+LATENCY_SAMPLES = 1024
+
+# Constants for running as several worker processes: whether each worker can
+# have a listening socket of its own on the same port, with the kernel sharing
+# new connections out between them, and how long to wait before starting a
+# worker again if it dies within that long of being started.
+
+USE_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+RESTART_DELAY = 1
 
 # Signal handler for graceful exiting.
 
@@ -22,17 +59,165 @@ def prepare_response_message(value):
     message = 'HTTP/1.1 '
     if value == '200':
         message = message + value + ' OK\r\n' + date_string + '\r\n'
+    elif value == '400':
+        message = message + value + ' Bad Request\r\n' + date_string + '\r\n'
     elif value == '404':
         message = message + value + ' Not Found\r\n' + date_string + '\r\n'
     elif value == '501':
         message = message + value + ' Method Not Implemented\r\n' + date_string + '\r\n'
     elif value == '505':
         message = message + value + ' Version Not Supported\r\n' + date_string + '\r\n'
+    elif value == '206':
+        message = message + value + ' Partial Content\r\n' + date_string + '\r\n'
+    elif value == '416':
+        message = message + value + ' Range Not Satisfiable\r\n' + date_string + '\r\n'
     return message
 
-# Send the given response and file back to the client.
+# Keep track of how busy the server is: how many connections are open, how
+# many requests we have served, and how long the most recent of them took.
+# Every mode updates the one set of numbers, so they are guarded by a lock.
+#
+# When running as several worker processes, each worker also keeps its numbers
+# in a slot of its own in an array shared between all of them: the open
+# connections, the requests served, then the times of the most recent requests,
+# going round and round.  Only the worker a slot belongs to writes to it, so
+# the slots need no lock, and any worker can add them all up for the report.
+
+SLOT_SIZE = 2 + LATENCY_SAMPLES
+
+class ServerStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.active_connections = 0
+        self.requests = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.shared = None
+        self.base = 0
+
+    # Start keeping our numbers in the given slot of the shared array.  A
+    # worker started again in place of one that died carries on from where
+    # that one left off, less its connections, which died with it.
+
+    def share(self, shared, slot):
+        with self.lock:
+            self.shared = shared
+            self.base = slot * SLOT_SIZE
+            self.requests = int(shared[self.base + 1])
+            shared[self.base] = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.active_connections += 1
+            if (self.shared is not None):
+                self.shared[self.base] = self.active_connections
+
+    def connection_closed(self):
+        with self.lock:
+            self.active_connections -= 1
+            if (self.shared is not None):
+                self.shared[self.base] = self.active_connections
+
+    # Record a request we have finished sending the response to, and how many
+    # seconds that took from the moment the request came in.
+
+    def record_request(self, seconds):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(seconds)
+            if (self.shared is not None):
+                self.shared[self.base + 2 + (self.requests - 1) % LATENCY_SAMPLES] = seconds
+                self.shared[self.base + 1] = self.requests
+
+    # Gather up the numbers for the report: ours alone, or those of every
+    # worker if there are several.
+
+    def gather(self):
+        if (self.shared is None):
+            return [self.active_connections, self.requests, list(self.latencies), 1]
+        active_connections = 0
+        requests = 0
+        latencies = []
+        workers = len(self.shared) // SLOT_SIZE
+        for base in range(0, len(self.shared), SLOT_SIZE):
+            active_connections += int(self.shared[base])
+            requests += int(self.shared[base + 1])
+            latencies.extend(self.shared[base + 2:base + 2 + min(int(self.shared[base + 1]), LATENCY_SAMPLES)])
+        return [active_connections, requests, latencies, workers]
+
+    # Produce the report sent back for the health path, one name: value pair to
+    # a line.  The latencies are given as the 50th, 90th and 99th percentile of
+    # the recent requests, in seconds.
+
+    def report(self):
+        with self.lock:
+            active_connections, requests, latencies, workers = self.gather()
+            latencies.sort()
+            lines = ['active_connections: ' + str(active_connections), 'requests: ' + str(requests), 'workers: ' + str(workers), 'uptime: ' + format(time.monotonic() - self.started, '.0f')]
+        if hasattr(os, 'getloadavg'):
+            lines.append('load: ' + ' '.join(format(load, '.2f') for load in os.getloadavg()))
+        for percentile in (50, 90, 99):
+            value = latencies[min(len(latencies) * percentile // 100, len(latencies) - 1)] if latencies else 0
+            lines.append('latency_p' + str(percentile) + ': ' + format(value, '.6f'))
+        return '\r\n'.join(lines) + '\r\n'
+
+server_stats = ServerStats()
+
+# Construct the whole response for the health path: the report on how the
+# server is doing, as plain text.
+
+def prepare_health_response(keep_alive):
+
+    body = server_stats.report().encode()
+    if keep_alive:
+        connection = 'keep-alive'
+    else:
+        connection = 'close'
+    header = prepare_response_message('200') + 'Content-Type: text/plain\r\nContent-Length: ' + str(len(body)) + '\r\nCache-Control: no-store\r\nConnection: ' + connection + '\r\n\r\n'
+    return header.encode() + body
+
+# Work out which bytes of a file a request with a Range header asks for.  We
+# return None if the whole file should be sent, the first and last bytes to
+# send if the range is one we can send, and False if it starts past the end of
+# the file.  Only a single range is handled; a request for several ranges, or
+# one we can't make sense of, is sent the whole file instead.
+# If the request came with an If-Range header we send the whole file, as we have
+# no validators to check it against.
+
+def parse_range(headers, stat):
+    value = headers.get('range', '')
+    if ((not value.startswith('bytes=')) or (',' in value)):
+        return None
+    if ('if-range' in headers):
+        return None
+    first, _, last = value[6:].strip().partition('-')
+    try:
+        if (first == ''):
+            first = stat.st_size - int(last)
+            last = stat.st_size - 1
+        else:
+            first = int(first)
+            last = int(last) if last else stat.st_size - 1
+    except ValueError:
+        return None
+    if (first >= stat.st_size):
+        return False
+    if (last < first):
+        return None
+    return (max(first, 0), min(last, stat.st_size - 1))
+
+# Check whether a response with the given code is followed by the file, rather
+# than being a header alone.
 
-def send_response_to_client(sock, code, file_name):
+def response_has_body(code):
+    return ((code != '304') and (code != '416'))
+
+# Construct the header for a response sending back the given file, telling the
+# client whether we will keep the connection open afterwards.  A 206 says which
+# bytes of the file follow, and a 416 how big the file really is.
+
+def prepare_response_header(code, file_name, keep_alive, byte_range=None):
 
     # Determine content type of file
 
@@ -51,114 +236,730 @@ def send_response_to_client(sock, code, file_name):
 
     file_size = os.path.getsize(file_name)
 
+    if keep_alive:
+        connection = 'keep-alive'
+    else:
+        connection = 'close'
+
+    header = prepare_response_message(code)
+    if (code == '206'):
+        header = header + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(byte_range[1] - byte_range[0] + 1) + '\r\n'
+        header = header + 'Content-Range: bytes ' + str(byte_range[0]) + '-' + str(byte_range[1]) + '/' + str(file_size) + '\r\n'
+    elif (code == '416'):
+        header = header + 'Content-Range: bytes */' + str(file_size) + '\r\nContent-Length: 0\r\n'
+    else:
+        header = header + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(file_size) + '\r\n'
+    if ((code == '200') or (code == '206')):
+        header = header + 'Accept-Ranges: bytes\r\n'
+    return header + 'Connection: ' + connection + '\r\n\r\n'
+
+# Send the contents of an open file down a socket, or count bytes of it from
+# offset on if we are given them.  Where we can, we let the kernel copy the
+# file straight to the socket with sendfile.  Otherwise we fall back to reading
+# the file into one large buffer at a time and sending that.
+
+def send_file_to_socket(sock, file_to_send, offset=0, count=None):
+
+    if USE_SENDFILE:
+        sock.sendfile(file_to_send, offset, count)
+        return
+
+    buffer = bytearray(SEND_BUFFER_SIZE)
+    view = memoryview(buffer)
+    file_to_send.seek(offset)
+    while ((count is None) or (count > 0)):
+        size = SEND_BUFFER_SIZE if (count is None) else min(SEND_BUFFER_SIZE, count)
+        read = file_to_send.readinto(view[:size])
+        if read:
+            sock.sendall(view[:read])
+        else:
+            break
+        if (count is not None):
+            count -= read
+
+# Send the given response and file back to the client, or just the bytes of it
+# in byte_range for a 206.  A 416 has no body, so we only send its header.
+
+def send_response_to_client(sock, code, file_name, keep_alive, byte_range=None):
+
+    # The health path has a report made up on the spot rather than a file.
+
+    if (file_name == HEALTH_PATH):
+        sock.sendall(prepare_health_response(keep_alive))
+        return
+
     # Construct header and send it
 
-    header = prepare_response_message(code) + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(file_size) + '\r\n\r\n'
-    sock.send(header.encode())
+    header = prepare_response_header(code, file_name, keep_alive, byte_range)
+    sock.sendall(header.encode())
+    if (not response_has_body(code)):
+        return
 
-    # Open the file, read it, and send it
+    # Open the file and send it
 
     with open(file_name, 'rb') as file_to_send:
+        if (byte_range is None):
+            send_file_to_socket(sock, file_to_send)
+        else:
+            send_file_to_socket(sock, file_to_send, byte_range[0], byte_range[1] - byte_range[0] + 1)
+
+# A buffered reader wrapped around a connected socket.  Rather than pulling a
+# single byte at a time off the socket, we read whatever is available into a
+# reusable buffer and split lines out of that.  Anything left over once the
+# headers are done is handed back first when the body is read.
+
+class SocketReader:
+
+    def __init__(self, sock, data=b''):
+        self.sock = sock
+        self.buffer = bytearray(data)
+        self.chunk = bytearray(READ_BUFFER_SIZE)
+        self.view = memoryview(self.chunk)
+
+    # Read more data from the socket into our buffer.  Returns the number of
+    # bytes read, which will be 0 once the other side closes the connection.
+
+    def fill(self):
+        count = self.sock.recv_into(self.chunk)
+        self.buffer += self.view[:count]
+        return count
+
+    # Read a single line (ending with \r\n) and return it.  We will strip out
+    # the \r and the \n in the process.  Bytes that aren't valid UTF-8 are
+    # replaced rather than failing, so a garbled request is just one we can't
+    # find the file for, not one that takes us down.
+
+    def get_line(self):
+        start = 0
         while True:
-            chunk = file_to_send.read(BUFFER_SIZE)
-            if chunk:
-                sock.send(chunk)
-            else:
-                break
+            index = self.buffer.find(b'\r\n', start)
+            if (index >= 0):
+                line = self.buffer[:index].decode(errors='replace')
+                del self.buffer[:index + 2]
+                return line
+            start = max(len(self.buffer) - 1, 0)
+            if (self.fill() == 0):
+                line = self.buffer.decode(errors='replace')
+                self.buffer.clear()
+                return line
 
-# Read a single line (ending with \n) from a socket and return it.
-# We will strip out the \r and the \n in the process.
+    # Read up to size bytes of a message body, returning anything still in our
+    # buffer before going back to the socket.
 
-def get_line_from_socket(sock):
+    def recv(self, size):
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        return self.sock.recv(size)
 
-    done = False
-    line = ''
-    while (not done):
-        char = sock.recv(1).decode()
-        if (char == '\r'):
-            pass
-        elif (char == '\n'):
-            done = True
-        else:
-            line = line + char
-    return line
 
-# Our main function.
+# Read a request from the client.  We return the request line along with a
+# dictionary of its headers, keyed by their names in lower case.
 
-def main():
+def read_request(reader):
 
-    # Register our signal handler for shutting down.
+    request = reader.get_line()
+    headers = {}
+    header_line = reader.get_line()
+    while (header_line != ''):
+        name, _, value = header_line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+        header_line = reader.get_line()
+    return request, headers
 
-    signal.signal(signal.SIGINT, signal_handler)
+# Check whether the client wants the connection kept open after this request.
+# HTTP/1.1 connections stay open unless the client asks for them to be closed.
 
-    # Create the socket.  We will ask this to work on any interface and to pick
-    # a free port at random.  We'll print this out for clients to use.
+def keep_connection_alive(request, headers):
+
+    return ((request.endswith('HTTP/1.1')) and (headers.get('connection', '').lower() != 'close'))
+
+# Look at a request and figure out what to do based on the contents of things.
+# We return the response code along with the file to send back to the client,
+# and the first and last bytes of it to send if only part of it was asked for.
+
+def process_request(request, headers):
+
+    request_list = request.split()
+
+    # If we did not get a request line with a command and a file at least,
+    # respond with a 400.
+
+    if (len(request_list) < 2):
+        print('Malformed request received ... responding with error!')
+        return '400', '400.html', None
+
+    # If we did not get a GET command respond with a 501.
+
+    elif request_list[0] != 'GET':
+        print('Invalid type of request received ... responding with error!')
+        return '501', '501.html', None
+
+    # If we did not get the proper HTTP version respond with a 505.
+
+    elif ((len(request_list) < 3) or (request_list[2] != 'HTTP/1.1')):
+        print('Invalid HTTP version received ... responding with error!')
+        return '505', '505.html', None
+
+    # We have the right request and version, so check if file exists.
+
+    # If requested file begins with a / we strip it off.
+
+    req_file = request_list[1].lstrip('/')
+
+    # A load balancer checking on us gets a report on how we are doing.
+
+    if (req_file == HEALTH_PATH):
+        return '200', HEALTH_PATH, None
+
+    # Check if requested file exists and report a 404 if not.  We have no
+    # index page, so a request for / gets one too.
+
+    if ((req_file == '') or (not os.path.isfile(req_file))):
+        print('Requested file does not exist ... responding with error!')
+        return '404', '404.html', None
+
+    # File exists, so prepare to send it!  
+
+    # If only part of the file was asked for, send back just that part, or a
+    # 416 if the part asked for lies past the end of the file.
+
+    if ('range' in headers):
+        byte_range = parse_range(headers, os.stat(req_file))
+        if (byte_range is False):
+            print('Requested range is past the end of the file ... responding with error!')
+            return '416', req_file, None
+        elif (byte_range is not None):
+            print('Requested range good to go!  Sending part of file ...')
+            return '206', req_file, byte_range
+
+    print('Requested file good to go!  Sending file ...')
+    return '200', req_file, None
+
+# Serve a client connection using blocking calls.  This is what each worker
+# runs in the serial and thread pool modes.  Unless persistent is False, we keep
+# serving requests on the connection for as long as the client wants, closing
+# it if the client goes quiet for IDLE_TIMEOUT.  Given somewhere to park idle
+# connections, we hand the connection over to it once we have answered every
+# request the client has sent so far, rather than tie up the thread waiting
+# for the next one.  It comes back to us with its reader when the client sends
+# more.
+
+def serve_client(conn, addr, persistent=True, idle=None, reader=None):
+
+    if reader is None:
+        print('Accepted connection from client address:', addr)
+        print('Connection to client established, waiting to receive message...')
+        server_stats.connection_opened()
+        reader = SocketReader(conn)
+    parked = False
+    try:
+        conn.settimeout(IDLE_TIMEOUT)
+        keep_alive = True
+        while keep_alive:
+            request, headers = read_request(reader)
+            if (request == ''):
+                break
+            print('Received request:  ' + request)
+            start_time = time.perf_counter()
+            code, file_name, byte_range = process_request(request, headers)
+            keep_alive = persistent and keep_connection_alive(request, headers)
+            send_response_to_client(conn, code, file_name, keep_alive, byte_range)
+            if (file_name != HEALTH_PATH):
+                server_stats.record_request(time.perf_counter() - start_time)
+            if (keep_alive and (idle is not None) and (not reader.buffer)):
+                idle.park(conn, addr, reader)
+                parked = True
+                return
+    except TimeoutError:
+        print('Connection to client idle for too long, closing it ...')
+    except OSError as error:
+        print('Error:  Connection to client failed:', error)
+
+    # We are all done with this client, so close the connection.
+
+    finally:
+        if (not parked):
+            conn.close()
+            server_stats.connection_closed()
+
+# Serve clients one at a time, exactly as the original server did.  We close
+# each connection after a single request so one client can't hold up the rest.
+
+def run_serial(server_socket):
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('', 0))
-    print('Will wait for client connections at port ' + str(server_socket.getsockname()[1]))
-    server_socket.listen(1)
-    
-    # Keep the server running forever.
-    
     while(1):
         print('Waiting for incoming client connection ...')
         conn, addr = server_socket.accept()
-        print('Accepted connection from client address:', addr)
-        print('Connection to client established, waiting to receive message...')
+        serve_client(conn, addr, False)
+
+# Hands connections to the pool of worker threads in thread mode, and looks
+# after the keep-alive connections between requests.  Only connections with a
+# request coming in are given a worker.  Idle ones are parked with a single
+# thread watching all of them, so a few quiet clients can't hold every worker
+# and keep everyone else waiting.  As soon as a parked connection has something
+# to read, it goes back to the pool; if it stays quiet for IDLE_TIMEOUT, it is
+# closed.
+
+class IdleConnections:
+
+    def __init__(self, pool, workers):
+        self.pool = pool
+        self.free_workers = threading.BoundedSemaphore(workers)
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.parked = []
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+
+    # Give a connection to a worker, waiting for one to be free first.
+
+    def serve(self, conn, addr, reader=None):
+        self.free_workers.acquire()
+        future = self.pool.submit(serve_client, conn, addr, True, self, reader)
+        future.add_done_callback(lambda future: self.free_workers.release())
+
+    # Park a connection until the client sends its next request.  This is
+    # called from the workers, so the connection is handed over to the
+    # watching thread to add to its selector.
+
+    def park(self, conn, addr, reader):
+        with self.lock:
+            self.parked.append((conn, addr, reader))
+        self.waker.send(b'\0')
+
+    # Watch the parked connections, forever.
+
+    def run(self):
+        while(1):
+            for key, events in self.selector.select(timeout=1):
+                if (key.fileobj is self.wakeup):
+                    self.add_parked()
+                else:
+                    self.selector.unregister(key.fileobj)
+                    conn, addr, reader, since = key.data
+                    self.serve(conn, addr, reader)
+            self.close_idle()
+
+    def add_parked(self):
+        try:
+            while self.wakeup.recv(READ_BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            parked = self.parked
+            self.parked = []
+        for conn, addr, reader in parked:
+            self.selector.register(conn, selectors.EVENT_READ, (conn, addr, reader, time.monotonic()))
+
+    # Close any parked connections we have not heard from in IDLE_TIMEOUT
+    # seconds.
+
+    def close_idle(self):
+        now = time.monotonic()
+        for key in list(self.selector.get_map().values()):
+            if ((key.data is not None) and (now - key.data[3] > IDLE_TIMEOUT)):
+                print('Connection to client idle for too long, closing it ...')
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close()
+                server_stats.connection_closed()
+
+# Serve clients with a bounded pool of worker threads.  Once we have accepted a
+# connection, we wait for a worker to be free to take it before accepting the
+# next, so anything beyond that waits in the listen backlog rather than piling
+# up in memory.
+
+def run_thread_pool(server_socket, workers):
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        idle = IdleConnections(pool, workers)
+        threading.Thread(target=idle.run, daemon=True).start()
+        while(1):
+            print('Waiting for incoming client connection ...')
+            conn, addr = server_socket.accept()
+            idle.serve(conn, addr)
+
+# State kept for each connection in the selector mode.  We hold on to the
+# reader while the request comes in, then the response still to be sent along
+# with how far through the file we are and where to stop, when the request
+# came in, and when we last heard from the client so idle connections can be
+# closed.
+
+class SelectorConnection:
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.reader = SocketReader(conn)
+        self.outgoing = memoryview(b'')
+        self.file = None
+        self.offset = 0
+        self.end = 0
+        self.keep_alive = True
+        self.started = None
+        self.last_active = time.monotonic()
+
+    # Get ready to read the next request once a response has been sent.
+
+    def finish_response(self):
+        if (self.started is not None):
+            server_stats.record_request(time.perf_counter() - self.started)
+        self.started = None
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.offset = 0
+        self.end = 0
+
+    def close(self, selector):
+        selector.unregister(self.conn)
+        self.conn.close()
+        server_stats.connection_closed()
+        if self.file:
+            self.file.close()
+
+# Accept a new connection in the selector mode and wait for its request.
+
+def selector_accept(selector, server_socket):
+
+    try:
+        conn, addr = server_socket.accept()
+    except BlockingIOError:
+        return
+    print('Accepted connection from client address:', addr)
+    conn.setblocking(False)
+    selector.register(conn, selectors.EVENT_READ, SelectorConnection(conn, addr))
+    server_stats.connection_opened()
+
+# If the whole of the next request is in, work out the response and switch over
+# to waiting until we can write it.  Otherwise keep waiting for the rest.
+
+def selector_next_request(selector, state):
+
+    if (state.reader.buffer.find(b'\r\n\r\n') < 0):
+        return
+
+    request, headers = read_request(state.reader)
+    print('Received request:  ' + request)
+    code, file_name, byte_range = process_request(request, headers)
+    state.keep_alive = keep_connection_alive(request, headers)
+    if (file_name == HEALTH_PATH):
+        state.outgoing = memoryview(prepare_health_response(state.keep_alive))
+        selector.modify(state.conn, selectors.EVENT_WRITE, state)
+        return
+    state.started = time.perf_counter()
+    state.outgoing = memoryview(prepare_response_header(code, file_name, state.keep_alive, byte_range).encode())
+    if response_has_body(code):
+        state.file = open(file_name, 'rb')
+        if (byte_range is None):
+            state.offset, state.end = 0, os.fstat(state.file.fileno()).st_size
+        else:
+            state.offset, state.end = byte_range[0], byte_range[1] + 1
+        state.file.seek(state.offset)
+    selector.modify(state.conn, selectors.EVENT_WRITE, state)
+
+# Read whatever has arrived on a connection and see if a request is ready.
+
+def selector_read(selector, state):
+
+    try:
+        count = state.reader.fill()
+    except BlockingIOError:
+        return
+    except OSError as error:
+        print('Error:  Connection to client failed:', error)
+        count = 0
+    if (count == 0):
+        state.close(selector)
+        return
+
+    state.last_active = time.monotonic()
+    try:
+        selector_next_request(selector, state)
+    except Exception as error:
+        print('Error:  Handling request from client failed:', repr(error))
+        state.close(selector)
+
+# Send as much of the response as the connection will take right now.  Once
+# the header is out we have the kernel copy the file across with sendfile, or
+# read more of it into memory if we can't.  Once it is all sent we either go
+# back to waiting for the next request or close the connection.
+
+def selector_write(selector, state):
+
+    try:
+        if (state.outgoing):
+            sent = state.conn.send(state.outgoing)
+            state.outgoing = state.outgoing[sent:]
+            return
+        if ((state.file is None) or (state.offset >= state.end)):
+            sent = 0
+        elif USE_SENDFILE:
+            sent = os.sendfile(state.conn.fileno(), state.file.fileno(), state.offset, min(SEND_BUFFER_SIZE, state.end - state.offset))
+            state.offset += sent
+        else:
+            chunk = state.file.read(min(SEND_BUFFER_SIZE, state.end - state.offset))
+            state.outgoing = memoryview(chunk)
+            sent = len(chunk)
+            state.offset += sent
+        state.last_active = time.monotonic()
+        if (sent != 0):
+            return
+        state.finish_response()
+        if state.keep_alive:
+            selector.modify(state.conn, selectors.EVENT_READ, state)
+            selector_next_request(selector, state)
+        else:
+            state.close(selector)
+    except BlockingIOError:
+        pass
+    except OSError as error:
+        print('Error:  Connection to client failed:', error)
+        state.close(selector)
+    except Exception as error:
+        print('Error:  Handling request from client failed:', repr(error))
+        state.close(selector)
+
+# Close any connections we have not heard from in IDLE_TIMEOUT seconds.
+
+def selector_close_idle(selector):
+
+    now = time.monotonic()
+    for key in list(selector.get_map().values()):
+        if ((key.data is not None) and (now - key.data.last_active > IDLE_TIMEOUT)):
+            print('Connection to client idle for too long, closing it ...')
+            key.data.close(selector)
+
+# Serve every client from a single thread, using non-blocking sockets and a
+# selector to work on whichever connections are ready.
+
+def run_selector(server_socket):
+
+    selector = selectors.DefaultSelector()
+    server_socket.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ)
+    print('Waiting for incoming client connections ...')
+    while(1):
+        for key, events in selector.select(timeout=1):
+            if (key.fileobj is server_socket):
+                selector_accept(selector, server_socket)
+            elif (events & selectors.EVENT_READ):
+                selector_read(selector, key.data)
+            else:
+                selector_write(selector, key.data)
+        selector_close_idle(selector)
 
-        # We obtain our request from the socket.  We look at the request and
-        # figure out what to do based on the contents of things.
+# Read a request from a stream in the asyncio mode.  We wait for the whole
+# request to arrive and then parse it the same way as the other modes do.
 
-        request = get_line_from_socket(conn)
-        print('Received request:  ' + request)
-        request_list = request.split()
+async def read_request_async(stream):
 
-        # This server doesn't care about headers, so we just clean them up.
+    try:
+        head = await stream.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        return '', {}
+    return read_request(SocketReader(None, head))
 
-        while (get_line_from_socket(conn) != ''):
-            pass
+# Send the given response and file back to the client over a stream.
 
-        # If we did not get a GET command respond with a 501.
+async def send_response_to_stream(writer, code, file_name, keep_alive, byte_range=None):
 
-        if request_list[0] != 'GET':
-            print('Invalid type of request received ... responding with error!')
-            send_response_to_client(conn, '501', '501.html')
+    # The health path has a report made up on the spot rather than a file.
 
-        # If we did not get the proper HTTP version respond with a 505.
+    if (file_name == HEALTH_PATH):
+        writer.write(prepare_health_response(keep_alive))
+        await writer.drain()
+        return
 
-        elif request_list[2] != 'HTTP/1.1':
-            print('Invalid HTTP version received ... responding with error!')
-            send_response_to_client(conn, '505', '505.html')
+    # Construct header and send it
 
-        # We have the right request and version, so check if file exists.
-                  
+    header = prepare_response_header(code, file_name, keep_alive, byte_range)
+    writer.write(header.encode())
+    if (not response_has_body(code)):
+        await writer.drain()
+        return
+
+    # Open the file and send it.  The event loop uses sendfile where it can,
+    # and otherwise reads the file in and writes it out for us.
+
+    with open(file_name, 'rb') as file_to_send:
+        if (byte_range is None):
+            await asyncio.get_running_loop().sendfile(writer.transport, file_to_send)
         else:
+            await asyncio.get_running_loop().sendfile(writer.transport, file_to_send, byte_range[0], byte_range[1] - byte_range[0] + 1)
+
+# Serve a single client connection in the asyncio mode, for as many requests as
+# the client wants to make on it.
+
+async def serve_client_async(stream, writer):
+
+    print('Accepted connection from client address:', writer.get_extra_info('peername'))
+    server_stats.connection_opened()
+    try:
+        keep_alive = True
+        while keep_alive:
+            request, headers = await asyncio.wait_for(read_request_async(stream), IDLE_TIMEOUT)
+            if (request == ''):
+                break
+            print('Received request:  ' + request)
+            start_time = time.perf_counter()
+            code, file_name, byte_range = process_request(request, headers)
+            keep_alive = keep_connection_alive(request, headers)
+            await send_response_to_stream(writer, code, file_name, keep_alive, byte_range)
+            if (file_name != HEALTH_PATH):
+                server_stats.record_request(time.perf_counter() - start_time)
+    except TimeoutError:
+        print('Connection to client idle for too long, closing it ...')
+    except OSError as error:
+        print('Error:  Connection to client failed:', error)
+
+    # We are all done with this client, so close the connection.
+
+    finally:
+        writer.close()
+        server_stats.connection_closed()
+
+# Serve every client from a single asyncio event loop.
+
+async def run_asyncio(server_socket, backlog):
+
+    server = await asyncio.start_server(serve_client_async, sock=server_socket, backlog=backlog)
+    print('Waiting for incoming client connections ...')
+    async with server:
+        await server.serve_forever()
+
+# Serve clients on the given socket in the given mode, forever.
+
+def run_server(server_socket, args):
+
+    if (args.mode == 'serial'):
+        run_serial(server_socket)
+    elif (args.mode == 'thread'):
+        run_thread_pool(server_socket, args.workers)
+    elif (args.mode == 'selector'):
+        run_selector(server_socket)
+    else:
+        asyncio.run(run_asyncio(server_socket, args.backlog))
+
+# Start a worker process to serve clients from the given slot.  Where we can,
+# the worker opens a listening socket of its own on our port, and the kernel
+# shares new connections out evenly between the workers.  Otherwise it serves
+# clients from the listening socket it inherits from us.  We return the
+# worker's process id.
+
+def start_worker(server_socket, args, shared, slot):
+
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # This is the worker.  It must never return to the supervisor's code, so
+    # however serving ends, we leave from here.
+
+    status = 1
+    try:
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        server_stats.share(shared, slot)
+        if USE_REUSEPORT:
+            port = server_socket.getsockname()[1]
+            server_socket.close()
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server_socket.bind(('', port))
+            server_socket.listen(args.backlog)
+        print('Worker ' + str(slot) + ' started with process id ' + str(os.getpid()))
+        run_server(server_socket, args)
+    except SystemExit:
+        status = 0
+    except BaseException as error:
+        print('Error:  Worker ' + str(slot) + ' failed:', repr(error))
+    finally:
+        os._exit(status)
+
+# Run as a supervisor over the given number of worker processes, each serving
+# clients on our port.  Whenever a worker dies, we start another in its place,
+# waiting RESTART_DELAY seconds first if it died straight after starting so a
+# worker that can't run doesn't spin.  When we are shut down, so are they.
+
+def run_workers(server_socket, args):
+
+    shared = RawArray('d', args.processes * SLOT_SIZE)
+    workers = {}
+    started = {}
+
+    def stop_workers(sig, frame):
+        print('Interrupt received, shutting down workers ...')
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    for slot in range(args.processes):
+        workers[start_worker(server_socket, args, shared, slot)] = slot
+        started[slot] = time.monotonic()
 
-            # If requested file begins with a / we strip it off.
+    while(1):
+        pid, status = os.wait()
+        slot = workers.pop(pid, None)
+        if (slot is None):
+            continue
+        print('Worker ' + str(slot) + ' (process id ' + str(pid) + ') exited with status ' + str(status) + ', starting it again ...')
+        if (time.monotonic() - started[slot] < RESTART_DELAY):
+            time.sleep(RESTART_DELAY)
+        workers[start_worker(server_socket, args, shared, slot)] = slot
+        started[slot] = time.monotonic()
 
-            req_file = request_list[1]
-            while (req_file[0] == '/'):
-                req_file = req_file[1:]
+# Our main function.
 
-            # Check if requested file exists and report a 404 if not.
+def main():
 
-            if (not os.path.exists(req_file)):
-                print('Requested file does not exist ... responding with error!')
-                send_response_to_client(conn, '404', '404.html')
+    # Check command line arguments for how we should handle connections.
 
-            # File exists, so prepare to send it!  
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-mode", choices=['serial', 'thread', 'selector', 'asyncio'], default='thread', help="How to handle client connections")
+    parser.add_argument("-workers", type=int, default=DEFAULT_WORKERS, help="Number of worker threads in thread mode")
+    parser.add_argument("-backlog", type=int, default=LISTEN_BACKLOG, help="Number of pending connections to queue")
+    parser.add_argument("-processes", type=int, default=1, help="Number of worker processes to serve clients with")
+    args = parser.parse_args()
 
-            else:
-                print('Requested file good to go!  Sending file ...')
-                send_response_to_client(conn, '200', req_file)
-                
-        # We are all done with this client, so close the connection and
-        # Go back to get another one!
+    if ((args.processes > 1) and (not hasattr(os, 'fork'))):
+        print('Worker processes are not supported on this platform, running as a single process.')
+        args.processes = 1
+
+    # Register our signal handler for shutting down.
 
-        conn.close();
+    signal.signal(signal.SIGINT, signal_handler)
+
+    # Create the socket.  We will ask this to work on any interface and to pick
+    # a free port at random.  We'll print this out for clients to use.
+    # With several worker processes that each listen for themselves, we only
+    # hold on to the port here and leave the listening to them.
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if ((args.processes > 1) and USE_REUSEPORT):
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind(('', 0))
+    print('Will wait for client connections at port ' + str(server_socket.getsockname()[1]))
+    if ((args.processes == 1) or (not USE_REUSEPORT)):
+        server_socket.listen(args.backlog)
+    
+    # Keep the server running forever.
+
+    if (args.processes > 1):
+        run_workers(server_socket, args)
+    else:
+        run_server(server_socket, args)
     
 
 if __name__ == '__main__':
     main()
-